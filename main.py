@@ -1,4 +1,9 @@
+from array import array
+import hashlib
 import json
+import os
+import struct
+import sys
 from tkinter import *
 from tkinter import filedialog, messagebox, scrolledtext, ttk
 import seria
@@ -9,7 +14,16 @@ __version__ = '0.2.1'
 _TIP_FILE = 'Open a file to view details'
 _TIP_NODE = 'Click on an item to view details'
 _CFG_PATH = 'config.json'
-_CFG_SET = ('gamepath', 'oid_text')
+_CFG_SET = ('gamepath',)
+# configs of earlier versions also hold the whole text table, it is now kept in the text cache
+_CFG_LEGACY_SET = ('gamepath', 'oid_text')
+_SHIP_NAME_PATH = 'Frame/Body[m_name=COMBRIDGE]/Creature@m_ship_name'
+_DIALOG_PATH = '/Data/Dialogs/english.seria_enc'
+_TEXT_CACHE_PATH = 'text.cache'
+_TEXT_CACHE_MAGIC = b'SVTX'
+_TEXT_CACHE_VERSION = 1
+# magic, version, size, modification time and hash of the dialog file, number of texts
+_TEXT_CACHE_HEADER = struct.Struct('<4sHQq16sI')
 
 
 class SeriaController:
@@ -20,6 +34,7 @@ class SeriaController:
         self.root.minsize(640, 480)
 
         self.config: dict = dict()
+        self.text: TextCache = None
 
         # Data model
         self.var_viewmode = IntVar(value=0)
@@ -45,6 +60,8 @@ class SeriaController:
         # Tree view
         self.frm_treeview: Frame = None
         self.tree_seria: ttk.Treeview = None
+        # item id to seria node, the items of a node are only made when the node is opened
+        self.tree_seria_nodes = dict()
         self.text_treeview_detail: scrolledtext.ScrolledText = None
 
         self._make_menu()
@@ -57,16 +74,11 @@ class SeriaController:
         self.root.mainloop()
 
     def _load_config(self):
+        # the config is only written once the text of the game is loaded
+        changed = False
         try:
-            file = open(_CFG_PATH, 'r')
-
-            config = json.load(file)
-            if tuple(config.keys()) != _CFG_SET:
-                messagebox.showerror(
-                    'Config', 'Invalid config file, please delete it')
-                return
-
-            self.config = config
+            with open(_CFG_PATH, 'r') as file:
+                config = json.load(file)
         except FileNotFoundError:
             gamepath = filedialog.askdirectory(
                 title='Select HighFleet game folder')
@@ -75,17 +87,28 @@ class SeriaController:
                 messagebox.showwarning('Config', 'Game folder not selected')
                 return
 
-            self.config['gamepath'] = gamepath
-
-            oid_text = load_text(gamepath)
-            if oid_text is None:
+            config = {'gamepath': gamepath}
+            changed = True
+        else:
+            if tuple(config.keys()) == _CFG_LEGACY_SET:
+                del config['oid_text']
+                changed = True
+            elif tuple(config.keys()) != _CFG_SET:
                 messagebox.showerror(
-                    'Config', 'Failed to load dialog file')
+                    'Config', 'Invalid config file, please delete it')
                 return
 
-            self.config['oid_text'] = oid_text
+        self.config = config
 
-            json.dump(self.config, open(_CFG_PATH, 'w'))
+        self.text = TextCache.load(config['gamepath'])
+        if self.text is None:
+            messagebox.showerror(
+                'Config', 'Failed to load dialog file')
+            return
+
+        if changed:
+            with open(_CFG_PATH, 'w') as file:
+                json.dump(config, file)
 
     def _make_menu(self):
         def show_about():
@@ -252,7 +275,7 @@ More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
 
             # squadron treeview
             squadron_iid = self.tree_squadron.insert('', 'end', text=name)
-            for ship in squadron.filter_nodes(lambda n: n.header == 'm_children=7'):
+            for ship in squadron.get_nodes_by_header('m_children=7'):
                 self.tree_squadron.insert(squadron_iid, 'end',
                                           text=self.get_ship_name(ship))
 
@@ -367,42 +390,52 @@ More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
         self.text_treeview_detail.pack(expand=True, fill=BOTH)
 
         self.tree_seria.bind('<<TreeviewSelect>>', self._on_tree_seria_select)
+        self.tree_seria.bind('<<TreeviewOpen>>', self._on_tree_seria_open)
+
+    def _get_node_summary(self, node: seria.SeriaNode):
+        classname = node.get_attribute('m_classname')
+        name = node.get_attribute('m_name')
+        codename = node.get_attribute('m_codename')
+        fullname = node.get_attribute('m_fullname')
+
+        if classname == 'Escadra':
+            return f'Squadron {name}'
+        if classname == 'Location':
+            return f'City {name} ({codename})'
+        if classname == 'NPC':
+            return f'{classname} {fullname}' if str.isalpha(name) and fullname else classname
+        if classname == 'Node':
+            ship_name = self.get_ship_name(node)
+            return classname if ship_name is None else f'{classname} {ship_name}'
+        if classname == 'Body':
+            return f'{classname} {name}' if name else classname
+        return classname
+
+    def _insert_tree_nodes(self, parent_iid: str, nodes):
+        '''Insert an item for each node, an item of a node with children gets an empty placeholder child
+        so that it can be opened. The placeholder is replaced by the items of the children on the first open.'''
+
+        for node in nodes:
+            iid = self.tree_seria.insert(
+                parent_iid, 'end', text=self._get_node_summary(node))
+            self.tree_seria_nodes[iid] = node
+            if node.get_node_if(lambda child: True) is not None:
+                self.tree_seria.insert(iid, 'end')
+
+    def _open_tree_item(self, iid: str):
+        children = self.tree_seria.get_children(iid)
+        if len(children) == 1 and children[0] not in self.tree_seria_nodes:
+            self.tree_seria.delete(children[0])
+            self._insert_tree_nodes(iid, self.tree_seria_nodes[iid].get_nodes())
 
     def _update_treeview(self):
-        def get_node_summary(node: seria.SeriaNode):
-            classname = node.get_attribute('m_classname')
-            name = node.get_attribute('m_name')
-            codename = node.get_attribute('m_codename')
-            fullname = node.get_attribute('m_fullname')
-
-            if classname == 'Escadra':
-                return f'Squadron {name}'
-            if classname == 'Location':
-                return f'City {name} ({codename})'
-            if classname == 'NPC':
-                return f'{classname} {fullname}' if str.isalpha(name) and fullname else classname
-            if classname == 'Node':
-                ship_name = self.get_ship_name(node)
-                return classname if ship_name is None else f'{classname} {ship_name}'
-            if classname == 'Body':
-                return f'{classname} {name}' if name else classname
-            return classname
-
-        def append_children(node: seria.SeriaNode, parent_id: str):
-            node_id = self.tree_seria.insert(
-                parent_id, 'end', text=get_node_summary(node))
-            for child in node.get_nodes():
-                append_children(child, node_id)
-
         self.tree_seria.delete(*self.tree_seria.get_children())
+        self.tree_seria_nodes.clear()
 
-        # populate tree with seria nodes
-        root_id = self.tree_seria.insert(
-            '', 'end', text=get_node_summary(self.seria))
-
-        for node in self.seria.get_nodes():
-            append_children(node, root_id)
-
+        # only the root node and its children, deeper items are made when they are opened
+        self._insert_tree_nodes('', (self.seria,))
+        root_id = self.tree_seria.get_children()[0]
+        self._open_tree_item(root_id)
         self.tree_seria.item(root_id, open=True)
 
         self.text_treeview_detail.config(state=NORMAL)
@@ -440,6 +473,9 @@ More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
         self.frm_hold_control.pack_forget()
         self.frm_ammo_control.pack(expand=True, fill=BOTH)
 
+    def _on_tree_seria_open(self, event):
+        self._open_tree_item(event.widget.focus())
+
     def _on_tree_seria_select(self, event):
         def print_key_value(k, v):
             return f'{k}: {v}\n' if not k.startswith('_') else f'{v}\n'
@@ -457,41 +493,20 @@ More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
                         'end', print_key_value(key, value))
             self.text_treeview_detail.config(state=DISABLED)
 
-        iid = event.widget.focus()
-        parent_iid = self.tree_seria.parent(iid)
-
-        if parent_iid == '':
-            print_node_attributes(self.seria)
+        node = self.tree_seria_nodes.get(event.widget.focus())
+        if node is None:
             return
 
-        # node index sequence (from root to selected node)
-        index_sequence = []
-        while parent_iid != '':
-            index_sequence.insert(0, self.tree_seria.index(iid))
-            iid = parent_iid
-            parent_iid = self.tree_seria.parent(iid)
-
-        node = self.seria
-        for index in index_sequence:
-            node = node.get_node(index)
-
         print_node_attributes(node)
 
     def get_ship_name(self, node: seria.SeriaNode):
-        try:
-            frame = node.get_node_by_class('Frame')
-            body = frame.get_node_if(
-                lambda n: n.get_attribute('m_name') == 'COMBRIDGE')
-            creature = body.get_node_by_class('Creature')
-            return creature.get_attribute('m_ship_name')
-        except:
-            return None
+        return node.select_one(_SHIP_NAME_PATH)
 
     def get_item_name(self, oid: str):
-        if self.config is None:
+        if self.text is None:
             return oid
-        desc = self.config["oid_text"].get(f"{oid}_SDESC", "")
-        return f'{self.config["oid_text"].get(oid, oid)} {desc if desc == "" else f"({desc})"}'
+        desc = self.text.get(f"{oid}_SDESC", "")
+        return f'{self.text.get(oid, oid)} {desc if desc == "" else f"({desc})"}'
 
     def get_ammo_type(self, index: str):
         ammo_types = {
@@ -524,17 +539,20 @@ More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
             filetypes=[('Seria files', '*.seria')])
 
         if file_path:
-            self.seria = seria.load(file_path)
+            self.close_file()
+            self.seria = seria.load(file_path, lazy=True)
+            # keep the file in memory instead of a mapping, so that the game can still write it
+            seria.detach(self.seria)
 
             self.var_bonus.set(self.seria.get_attribute('m_scores'))
             self.var_cash.set(self.seria.get_attribute('m_cash'))
 
             self.ammo_nodes = self.seria.get_nodes_by_class('Item')
-            self.squadron_nodes = self.seria.filter_nodes(
-                lambda n: n.header == 'm_escadras=327' and n.get_attribute('m_name') in {'MARK', 'DETACHMENT'})
+            self.squadron_nodes = [n for n in self.seria.get_nodes_by_header('m_escadras=327')
+                                   if n.get_attribute('m_name') in {'MARK', 'DETACHMENT'}]
             for squadron in self.squadron_nodes:
                 self.squadron_hold_nodes.append(
-                    squadron.get_node_if(lambda n: n.header == 'm_inventory=7'))
+                    squadron.get_node_by_header('m_inventory=7'))
 
             self._update_baseview()
             self._update_treeview()
@@ -549,13 +567,18 @@ More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
             filetypes=[('Seria files', '*.seria')])
 
         if filepath:
-            seria.dump(self.seria, filepath)
-            messagebox.showinfo('Save', f'File saved to: {filepath}')
+            if seria.dump(self.seria, filepath):
+                messagebox.showinfo('Save', f'File saved to: {filepath}')
+            else:
+                messagebox.showerror('Save', f'Failed to save file: {filepath}')
 
     def close_file(self):
         if self.seria is None:
             return
         self.seria = None
+        self.squadron_nodes = list()
+        self.squadron_hold_nodes = list()
+        self.ammo_nodes = list()
 
         # clear base view
         self.entry_bonus.config(state=DISABLED)
@@ -566,6 +589,7 @@ More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
 
         # clear tree view
         self.tree_seria.delete(*self.tree_seria.get_children())
+        self.tree_seria_nodes.clear()
         self.text_treeview_detail.config(state=NORMAL)
         self.text_treeview_detail.delete(1.0, END)
         self.text_treeview_detail.insert('end', _TIP_FILE)
@@ -574,6 +598,126 @@ More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
         self.root.title(f'SeriaView v{__version__}')
 
 
+class TextCache:
+    '''In-game text of the dialog file, kept in a compact file so that it is not parsed on every start.
+    After a header, the file holds a table of offsets, then the keys sorted as UTF-8 bytes
+    and the texts in the same order. A text is found with a binary search over the keys
+    when it is asked for. The header holds the size, modification time and hash of the dialog file,
+    the cache is built again when the dialog file changes.'''
+
+    def __init__(self, data: bytes):
+        '''@param data: the content of a cache file.'''
+
+        self.data = data
+        self.count = _TEXT_CACHE_HEADER.unpack_from(data)[-1]
+        offsets = array('I')
+        offsets.frombytes(data[_TEXT_CACHE_HEADER.size:_TEXT_CACHE_HEADER.size + (self.count * 2 + 1) * 4])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        if len(offsets) != self.count * 2 + 1 or offsets[-1] != len(data):
+            raise ValueError('truncated text cache')
+        # positions in data, the last key offset is the first text offset
+        self.key_offsets = offsets[:self.count + 1]
+        self.text_offsets = offsets[self.count:]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _key(self, index: int) -> bytes:
+        return self.data[self.key_offsets[index]:self.key_offsets[index + 1]]
+
+    def get(self, key: str, default: str = None) -> str:
+        encoded_key = key.encode('utf-8')
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < encoded_key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == self.count or self._key(low) != encoded_key:
+            return default
+        return self.data[self.text_offsets[low]:self.text_offsets[low + 1]].decode('utf-8')
+
+    @staticmethod
+    def encode(text_map: dict, status: os.stat_result, digest: bytes) -> bytes:
+        '''Pack a dictionary from load_text into the content of a cache file for the dialog file.'''
+
+        items = sorted((key.encode('utf-8'), text.encode('utf-8')) for key, text in text_map.items())
+        parts = [key for key, _ in items] + [text for _, text in items]
+
+        # one offset table for the keys and the texts, the end of the keys is the start of the texts
+        offsets = array('I', [_TEXT_CACHE_HEADER.size + (len(parts) + 1) * 4])
+        for part in parts:
+            offsets.append(offsets[-1] + len(part))
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+
+        header = _TEXT_CACHE_HEADER.pack(
+            _TEXT_CACHE_MAGIC, _TEXT_CACHE_VERSION, status.st_size, status.st_mtime_ns, digest, len(items))
+        return b''.join([header, offsets.tobytes()] + parts)
+
+    @staticmethod
+    def _digest(filepath: str) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.digest()
+
+    @classmethod
+    def load(cls, gamepath: str, filepath: str = _TEXT_CACHE_PATH):
+        '''Load the text of a game from the cache file, or build the cache file from the dialog file.
+        @return: a TextCache, or None if the dialog file could not be read.'''
+
+        dialog_path = gamepath + _DIALOG_PATH
+        try:
+            status = os.stat(dialog_path)
+        except OSError:
+            print(f'Error: cannot open file {dialog_path}')
+            return None
+
+        digest = None
+        try:
+            with open(filepath, 'rb') as file:
+                data = file.read()
+            magic, version, size, mtime, cache_digest, count = _TEXT_CACHE_HEADER.unpack_from(data)
+            if (magic, version, size) == (_TEXT_CACHE_MAGIC, _TEXT_CACHE_VERSION, status.st_size):
+                if mtime != status.st_mtime_ns:
+                    # a copy of the game files has a new modification time, but the same content
+                    digest = cls._digest(dialog_path)
+                    if digest == cache_digest:
+                        data = _TEXT_CACHE_HEADER.pack(
+                            magic, version, size, status.st_mtime_ns, digest, count) + data[_TEXT_CACHE_HEADER.size:]
+                        cls._store(filepath, data)
+                if digest is None or digest == cache_digest:
+                    return cls(data)
+        except FileNotFoundError:
+            pass
+        except (OSError, struct.error, ValueError) as error:
+            print(f'Error: cannot read file {filepath}: {error}')
+
+        text_map = load_text(gamepath)
+        if text_map is None:
+            return None
+
+        data = cls.encode(text_map, status, digest or cls._digest(dialog_path))
+        cls._store(filepath, data)
+        return cls(data)
+
+    @staticmethod
+    def _store(filepath: str, data: bytes):
+        temporary = filepath + '.tmp'
+        try:
+            with open(temporary, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, filepath)
+        except OSError:
+            print(f'Error: cannot write file {filepath}')
+
+
 def load_text(gamepath):
     '''Load in-game text from resource file, return as a dictionary
     @return: key(oid), value(text)'''
@@ -592,389 +736,14 @@ def load_text(gamepath):
 
 
 def dec_seria(filepath):
+    dialog_path = filepath + _DIALOG_PATH
     try:
-        dialog_path = filepath + '/Data/Dialogs/english.seria_enc'
-        file = open(dialog_path, 'rb')
-        data = list(file.read())
-        a = 0
-        b = 2531011
-        while a < len(data):
-            data[a] = (b ^ (b >> 15) ^ data[a]) & 0xff
-            b += 214013
-            b &= 0xffffffff
-            a += 1
-        return bytes(data).decode('cp1251').split('\n')
-    except:
+        with seria.open_encrypted(dialog_path, 'rb') as file:
+            return file.read().decode('cp1251').split('\n')
+    except IOError:
         print(f'Error: cannot open file {dialog_path}')
         return None
 
 
 if __name__ == '__main__':
     SeriaController()
-=======
-from tkinter import *
-from tkinter import filedialog, messagebox, scrolledtext, ttk
-import seria
-
-__author__ = 'Max'
-__version__ = '0.1.0'
-
-_TIP_FILE = 'Open a file to view details'
-_TIP_NODE = 'Click on an item to view details'
-
-
-class SeriaController:
-    def __init__(self):
-        self.root = Tk()
-        self.root.title(f'SeriaView v{__version__}')
-        self.root.geometry('640x480')
-        self.root.minsize(640, 480)
-
-        # Data model
-        self.var_viewmode = IntVar(value=0)
-        self.var_filepath: str = StringVar()
-        self.seria: seria.SeriaNode = None
-        # reference to seria node, easy to modify
-        self.ammo_nodes = list()
-        self.squadron_nodes = list()
-
-        # Base view
-        self.frm_baseview: Frame = None
-        self.tree_ammo: ttk.Treeview = None
-        self.tree_squadron: ttk.Treeview = None
-
-        # TODO Map view
-        # self.frm_map: Frame = None
-
-        # Tree view
-        self.frm_treeview: Frame = None
-        self.tree_seria: ttk.Treeview = None
-        self.text_treeview_detail: scrolledtext.ScrolledText = None
-
-        self._make_menu()
-        self._make_baseview()
-        self._make_treeview()
-        # TODO make map view
-        self._on_view_change()
-
-        self.root.mainloop()
-
-    def _make_menu(self):
-        def show_about():
-            messagebox.showinfo(
-                'About', f'''SeriaView v{__version__}
-Developed by {__author__}
-More information at: https://github.com/DKAMX/HighFleet-SeriaView''')
-
-        menubar = Menu(self.root)
-        self.root.config(menu=menubar)
-
-        menu_file = Menu(menubar, tearoff=False)
-        menu_file.add_command(label='Open', command=self.open_file)
-        menu_file.add_command(label='Save', command=self.save_file)
-        menu_file.add_command(label='Close', command=self.close_file)
-        menubar.add_cascade(label='File', menu=menu_file)
-
-        menu_view = Menu(menubar, tearoff=False)
-        menu_view.add_radiobutton(label='Base view', command=self._on_view_change,
-                                  value=0, variable=self.var_viewmode)
-        # menu_view.add_radiobutton(label='Map view', command=self._on_view_change,
-        #                           value=1, variable=self.view_mode)
-        menu_view.add_radiobutton(label='Tree view', command=self._on_view_change,
-                                  value=2, variable=self.var_viewmode)
-        menubar.add_cascade(label='View', menu=menu_view)
-
-        menubar.add_command(label='About', command=show_about)
-
-    def _on_view_change(self):
-        if self.var_viewmode.get() == 0:
-            self.frm_baseview.pack(expand=True, fill=BOTH)
-            # self.frm_map.pack_forget()
-            self.frm_treeview.pack_forget()
-        elif self.var_viewmode.get() == 1:
-            pass
-            # TODO
-            # self.frm_base.pack_forget()
-            # self.frm_map.pack(expand=True, fill=BOTH)
-            # self.frm_tree.pack_forget()
-        elif self.var_viewmode.get() == 2:
-            self.frm_baseview.pack_forget()
-            # self.frm_map.pack_forget()
-            self.frm_treeview.pack(expand=True, fill=BOTH)
-
-    def _make_baseview(self):
-        self.frm_baseview = Frame(self.root)
-        self.frm_baseview.columnconfigure(0, weight=1)
-        self.frm_baseview.columnconfigure(1, weight=1)
-        self.frm_baseview.rowconfigure(0, weight=2)
-        self.frm_baseview.rowconfigure(1, weight=1)
-
-        # special ammunition register panel
-        frm_ammo = LabelFrame(self.frm_baseview, text='Ammunition')
-        frm_ammo.grid(row=0, column=0, sticky=NSEW)
-        frm_ammo.propagate(False)
-
-        self.tree_ammo = ttk.Treeview(frm_ammo, columns=['type', 'count'],
-                                      selectmode=BROWSE)
-        self.tree_ammo.heading('#0', text='')
-        self.tree_ammo.heading('type', anchor=CENTER, text='TYPE')
-        self.tree_ammo.heading('count', anchor=CENTER, text='PCS')
-        self.tree_ammo.column('#0', width=0, stretch=NO)
-        self.tree_ammo.column('type', width=200)
-        self.tree_ammo.column('count', anchor=CENTER, width=50)
-        self.tree_ammo.pack(expand=True, fill=BOTH, side=LEFT)
-
-        sb_ammo = ttk.Scrollbar(frm_ammo, orient='vertical',
-                                command=self.tree_ammo.yview)
-        sb_ammo.pack(fill=Y, side=RIGHT)
-        self.tree_ammo.config(yscrollcommand=sb_ammo.set)
-
-        # player's squadron panel
-        frm_squadron = LabelFrame(self.frm_baseview, text='Squadron')
-        frm_squadron.grid(row=0, column=1, sticky=NSEW)
-        frm_squadron.propagate(False)
-
-        self.tree_squadron = ttk.Treeview(frm_squadron, selectmode=BROWSE,
-                                          show='tree')
-        self.tree_squadron.pack(expand=True, fill=BOTH, side=LEFT)
-
-        sb_squadron = ttk.Scrollbar(frm_squadron, orient='vertical',
-                                    command=self.tree_squadron.yview)
-        sb_squadron.pack(fill=Y, side=RIGHT)
-        self.tree_squadron.config(yscrollcommand=sb_squadron.set)
-
-        # control panel
-        frm_control = Frame(self.frm_baseview)
-        frm_control.grid(row=1, column=0, columnspan=2, sticky=NSEW)
-
-        btn_ammo_add_100 = Button(frm_control, text='Add 100 rounds',
-                                  command=self._add_ammo_100)
-        btn_ammo_add_100.pack(side=LEFT)
-        btn_ammo_add_500 = Button(frm_control, text='Add 500 rounds',
-                                  command=self._add_ammo_500)
-        btn_ammo_add_500.pack(side=LEFT)
-
-    def _update_baseview(self):
-        self._update_ammo_tree()
-
-        for squadron in self.squadron_nodes:
-            name = squadron.get_attribute('m_name')
-            tree_id = self.tree_squadron.insert('', 'end', text=name)
-            ships = squadron.filter_nodes(lambda n: n.header == 'm_children=7')
-            for ship in ships:
-                ship_name = ship.get_attribute('m_name')
-                self.tree_squadron.insert(tree_id, 'end', text=ship_name)
-
-    def _update_ammo_tree(self):
-        ammo_types = {
-            '8': '122mm Unguided rocket',
-            '13': '340mm Unguided rocket',
-            '14': '37mm Incendiary',
-            '15': '57mm Incendiary',
-            '16': '100mm Armor piercing',
-            '17': '100mm Proximity fuze',
-            '18': '100mm Incendiary',
-            '19': '130mm Armor piercing',
-            '20': '130mm Proximity fuze',
-            '21': '130mm Incendiary',
-            '22': '130mm Laser guided',
-            '23': '180mm Armor piercing',
-            '24': '180mm Proximity fuze',
-            '25': '180mm Incendiary',
-            '26': '180mm Laser guided',
-            '27': '220mm Incendiary',
-            '28': '300mm Incendiary',
-            '30': '100 kg General purpose bomb',
-            '31': '250 kg General purpose bomb',
-            '35': 'Air-to-air missile'
-        }
-
-        self.tree_ammo.delete(*self.tree_ammo.get_children())
-
-        node_index = 0
-        for ammo in self.ammo_nodes:
-            index = ammo.get_attribute('m_index')
-            if index in ammo_types:
-                # explicit set iid so it can be reused
-                self.tree_ammo.insert('', 'end', iid=node_index, values=(
-                    ammo_types[index], ammo.get_attribute('m_count')))
-                node_index += 1
-
-    def _add_ammo(self, amount: int):
-        # will always return str regardless of initial iid type
-        index = self.tree_ammo.focus()
-
-        if index == '':
-            return
-
-        ammo = self.ammo_nodes[int(index)]
-        ammo_count = int(ammo.get_attribute('m_count'))
-        ammo.set_attribute('m_count', str(ammo_count + amount))
-
-        self._update_ammo_tree()
-
-    def _add_ammo_100(self):
-        self._add_ammo(100)
-
-    def _add_ammo_500(self):
-        self._add_ammo(500)
-
-    def _make_treeview(self):
-        self.frm_treeview = Frame(self.root)
-        self.frm_treeview.columnconfigure(0, weight=1)
-        self.frm_treeview.columnconfigure(1, weight=1)
-        self.frm_treeview.rowconfigure(0, weight=1)
-
-        # seria tree panel
-        frm_tree = Frame(self.frm_treeview)
-        frm_tree.grid(row=0, column=0, sticky=NSEW)
-        frm_tree.propagate(False)
-
-        self.tree_seria = ttk.Treeview(frm_tree, selectmode=BROWSE,
-                                       show='tree')
-        self.tree_seria.pack(expand=True, fill=BOTH, side=LEFT)
-
-        sb_tree = ttk.Scrollbar(frm_tree, orient='vertical',
-                                command=self.tree_seria.yview)
-        sb_tree.pack(fill=Y, side=RIGHT)
-        self.tree_seria.config(yscrollcommand=sb_tree.set)
-
-        # seria node detail panel
-        frm_detail = Frame(self.frm_treeview)
-        frm_detail.grid(row=0, column=1, sticky=NSEW)
-        frm_detail.propagate(False)
-
-        self.text_treeview_detail = scrolledtext.ScrolledText(
-            frm_detail, width=40)
-        self.text_treeview_detail.insert('end', _TIP_FILE)
-        self.text_treeview_detail.config(state=DISABLED)
-        self.text_treeview_detail.pack(expand=True, fill=BOTH)
-
-        self.tree_seria.bind('<<TreeviewSelect>>', self._on_tree_seria_select)
-
-    def _update_treeview(self):
-        def get_node_summary(node: seria.SeriaNode):
-            classname = node.get_attribute('m_classname')
-            name = node.get_attribute('m_name')
-            codename = node.get_attribute('m_codename')
-            fullname = node.get_attribute('m_fullname')
-            code = node.get_attribute('m_code')
-            if classname == 'Escadra':
-                return f'Squadron {name}'
-            elif classname == 'Location':
-                return f'City {name} ({codename})'
-            elif classname == 'NPC':
-                return f'{classname} {fullname}' if str.isalpha(name) and fullname else classname
-            elif classname == 'Node':
-                return f'{classname} {name}' if code == '7' else classname
-            elif classname == 'Body':
-                return f'{classname} {name}' if name else classname
-            return classname
-
-        def append_children(node: seria.SeriaNode, parent_id: str):
-            node_id = self.tree_seria.insert(
-                parent_id, 'end', text=get_node_summary(node))
-            for child in node.get_nodes():
-                append_children(child, node_id)
-
-        self.tree_seria.delete(*self.tree_seria.get_children())
-
-        # populate tree with seria nodes
-        root_id = self.tree_seria.insert(
-            '', 'end', text=get_node_summary(self.seria))
-
-        for node in self.seria.get_nodes():
-            append_children(node, root_id)
-
-        self.tree_seria.item(root_id, open=True)
-
-        self.text_treeview_detail.config(state=NORMAL)
-        self.text_treeview_detail.delete(1.0, END)
-        self.text_treeview_detail.insert(
-            'end', _TIP_NODE)
-        self.text_treeview_detail.config(state=DISABLED)
-
-    def _on_tree_seria_select(self, event):
-        def print_key_value(k, v):
-            return f'{k}: {v}\n' if not k.startswith('_') else f'{v}\n'
-
-        def print_node_attributes(node: seria.SeriaNode):
-            self.text_treeview_detail.config(state=NORMAL)
-            self.text_treeview_detail.delete(1.0, END)
-            for key, value in node.get_attributes().items():
-                if isinstance(value, list):
-                    for v in value:
-                        self.text_treeview_detail.insert(
-                            'end', print_key_value(key, v))
-                else:
-                    self.text_treeview_detail.insert(
-                        'end', print_key_value(key, value))
-            self.text_treeview_detail.config(state=DISABLED)
-
-        node_id = event.widget.focus()
-        parent_id = self.tree_seria.parent(node_id)
-
-        if parent_id == '':
-            print_node_attributes(self.seria)
-            return
-
-        # node index sequence (from root to selected node)
-        index_sequence = []
-        while parent_id != '':
-            index_sequence.insert(0, self.tree_seria.index(node_id))
-            node_id = parent_id
-            parent_id = self.tree_seria.parent(node_id)
-
-        node = self.seria
-        for index in index_sequence:
-            node = node.get_node(index)
-
-        print_node_attributes(node)
-
-    def open_file(self):
-        file_path = filedialog.askopenfilename(
-            filetypes=[('Seria files', '*.seria')])
-
-        if file_path:
-            self.var_filepath = file_path
-            self.seria = seria.load(file_path)
-
-            self.ammo_nodes = self.seria.get_nodes_by_class('Item')
-            self.squadron_nodes = self.seria.filter_nodes(
-                lambda n: n.header == 'm_escadras=327' and n.get_attribute('m_name') in {'MARK', 'DETACHMENT'})
-
-            self._update_baseview()
-            self._update_treeview()
-
-            self.root.title(f'SeriaView v{__version__} - {file_path}')
-
-    def save_file(self):
-        if self.seria is None:
-            return
-
-        filepath = filedialog.asksaveasfilename(
-            filetypes=[('Seria files', '*.seria')])
-
-        if filepath:
-            seria.dump(self.seria, filepath)
-            messagebox.showinfo('Save', f'File saved to: {filepath}')
-
-    def close_file(self):
-        self.seria = None
-
-        # clear base view
-        self.tree_ammo.delete(*self.tree_ammo.get_children())
-        self.tree_squadron.delete(*self.tree_squadron.get_children())
-
-        # clear tree view
-        self.tree_seria.delete(*self.tree_seria.get_children())
-        self.text_treeview_detail.config(state=NORMAL)
-        self.text_treeview_detail.delete(1.0, END)
-        self.text_treeview_detail.insert('end', _TIP_FILE)
-        self.text_treeview_detail.config(state=DISABLED)
-
-        self.root.title(f'SeriaView v{__version__}')
-
-
-if __name__ == '__main__':
-    SeriaController()
\ No newline at end of file
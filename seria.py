@@ -1,6 +1,19 @@
+import errno
+import functools
+import gc
+import hashlib
+import heapq
+import io
 import logging
 import logging.config
+import marshal
+import mmap
+import os
 import re
+import shutil
+import struct
+import sys
+import weakref
 
 __author__ = 'Max'
 __version__ = '0.2.0'
@@ -8,36 +21,210 @@ __version__ = '0.2.0'
 ATTRIBUTE_PATTERN = r'([a-zA-Z][0-9a-zA-Z.:_]*)'
 VALUE_PATTERN = r'(.*)'
 
+# attributes that hold or reference an m_id, see docs/id dependency of nodes.md
+ID_ATTRIBUTE = 'm_id'
+ID_REFERENCES = ('m_master_id', 'm_owner_id', 'm_A.id', 'm_B.id', 'm_master.id', 'm_block.id')
+_ID_NAMES = frozenset((ID_ATTRIBUTE,) + ID_REFERENCES)
+
+_ATTRIBUTE_REGEX = re.compile(ATTRIBUTE_PATTERN + '=' + VALUE_PATTERN)
+_NAME_START_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_NAME_CHARS = _NAME_START_CHARS + '0123456789.:_'
+
+# tokens of a seria file
+_NODE_START = 0
+_NODE_END = 1
+_ATTRIBUTE = 2
+_TEXT = 3
+_SUBTREE = 4
+
+# visits of traverse
+ENTER = 0
+LEAVE = 1
+GROUP = 2
+
+# events of iterparse
+START_NODE = 0
+END_NODE = 1
+ATTRIBUTE = 2
+MESH_LINE = 3
+
+# axes and parts of a path, see compile_path
+_CHILD = 0
+_DESCENDANT = 1
+_PATH_STEP_REGEX = re.compile(r'\*|[a-zA-Z_][0-9a-zA-Z.:_]*')
+_PATH_PREDICATE_REGEX = re.compile(
+    r'\[\s*' + ATTRIBUTE_PATTERN + r'\s*(?:=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\]]*?))\s*)?\]')
+_PATH_ATTRIBUTE_REGEX = re.compile('@' + ATTRIBUTE_PATTERN)
+
+# a line that only holds a curly brace
+_BRACE_BYTES_REGEX = re.compile(rb'^[ \t\f\v]*([{}])[ \t\f\v]*(?=\r?$)', re.MULTILINE)
+
+# short values such as 'true', '0' and '1' repeat all over a file, they share one string object
+_VALUE_POOL = dict()
+_POOLED_VALUE_LENGTH = 4
+
+# lazy sources that map a file, a weak set of them by the real path of the file
+_mapped_sources = dict()
+
+# bump when the snapshot format of TreeCache changes
+_CACHE_VERSION = 1
+_CACHE_SUFFIX = '.tree'
+
+# the writer joins this many pieces of text before each write, files get a buffer of this size
+_WRITE_CHUNK_SIZE = 8192
+_WRITE_BUFFER_SIZE = 1 << 20
+
+# the linear congruential generator of the keystream of .seria_enc files
+_KEY_SEED = 2531011
+_KEY_STEP = 214013
+# the key of a byte only depends on the lowest 23 bits of the generator
+_KEY_MASK = 0x7fffff
+# the keystream is made for this many bytes at a time, one 32 bit lane of a big int per byte
+_KEY_LANES = 1 << 16
+# files with this suffix are encrypted with the keystream
+_ENCRYPTED_SUFFIX = '.seria_enc'
+
 # logging.basicConfig(level=logging.DEBUG)
 
 
 class alist:
     '''Association list that maintains the order of key-value pairs and allows insertion.
-    The dict part is used to store the data, while the list part is used to store the order of insertion.'''
+    The dict part is used to store the data and keeps the order while pairs are only appended or removed.
+    Once a pair is inserted before or after another key, a doubly linked list over the keys takes over the order.
+    Lookup, insertion before or after a key and removal take constant time.'''
+
+    __slots__ = ('data', 'prev_keys', 'next_keys', 'first', 'last')
 
     def __init__(self, data: dict = None):
-        self.data = data or dict()
-        self.order = list(data.keys())
+        self.data = dict(data) if data else dict()
+        # previous and next key of each key, None marks the ends of the list
+        self.prev_keys = None
+        self.next_keys = None
+        self.first = None
+        self.last = None
 
     def __iter__(self):
-        for key in self.order:
-            yield key, self.get(key)
+        if self.next_keys is None:
+            yield from self.data.items()
+            return
+
+        key = self.first
+        while key is not None:
+            # read the next key first, so that the current key can be removed while iterating
+            next_key = self.next_keys[key]
+            yield key, self.data[key]
+            key = next_key
 
     def __contains__(self, key) -> bool:
-        return key in self.keys()
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def order(self) -> list:
+        '''Keys in order.'''
+
+        return [key for key, _ in self]
+
+    def _make_links(self):
+        '''Switch from the order of the dict to the linked list.'''
+
+        if self.next_keys is not None:
+            return
+
+        keys = list(self.data)
+        self.prev_keys = dict(zip(keys, [None] + keys[:-1]))
+        self.next_keys = dict(zip(keys, keys[1:] + [None]))
+        self.first = keys[0] if keys else None
+        self.last = keys[-1] if keys else None
+
+    def _link(self, key, prev_key, next_key):
+        self.prev_keys[key] = prev_key
+        self.next_keys[key] = next_key
+
+        if prev_key is None:
+            self.first = key
+        else:
+            self.next_keys[prev_key] = key
+
+        if next_key is None:
+            self.last = key
+        else:
+            self.prev_keys[next_key] = key
+
+    def _unlink(self, key):
+        prev_key = self.prev_keys.pop(key)
+        next_key = self.next_keys.pop(key)
+
+        if prev_key is None:
+            self.first = next_key
+        else:
+            self.next_keys[prev_key] = next_key
+
+        if next_key is None:
+            self.last = prev_key
+        else:
+            self.prev_keys[next_key] = prev_key
 
     # list operations
 
     def index(self, key) -> int:
-        return self.order.index(key)
+        '''Get the position of a key. This walks the list, prefer insert_before and insert_after.'''
+
+        for index, (current, _) in enumerate(self):
+            if current == key:
+                return index
+        raise ValueError(f'{key} is not in alist')
 
     def insert(self, index, key, value):
+        '''Insert a key-value pair at a position. This walks the list, prefer insert_before and insert_after.'''
+
+        self._make_links()
+        if key in self.data:
+            self._unlink(key)
+
+        next_key = self.first
+        for _ in range(index):
+            if next_key is None:
+                break
+            next_key = self.next_keys[next_key]
+
         self.data[key] = value
-        self.order.insert(index, key)
+        self._link(key, self.last if next_key is None else self.prev_keys[next_key], next_key)
+
+    def insert_before(self, before, key, value):
+        '''Insert a key-value pair before an existing key. A key cannot move before itself, its value is updated.'''
+
+        if key == before:
+            self.data[key] = value
+            return
+
+        self._make_links()
+        if key in self.data:
+            self._unlink(key)
+
+        self.data[key] = value
+        self._link(key, self.prev_keys[before], before)
+
+    def insert_after(self, after, key, value):
+        '''Insert a key-value pair after an existing key. A key cannot move after itself, its value is updated.'''
+
+        if key == after:
+            self.data[key] = value
+            return
+
+        self._make_links()
+        if key in self.data:
+            self._unlink(key)
+
+        self.data[key] = value
+        self._link(key, after, self.next_keys[after])
 
     def remove(self, key):
         del self.data[key]
-        self.order.remove(key)
+        if self.next_keys is not None:
+            self._unlink(key)
 
     # dict operations
 
@@ -45,24 +232,170 @@ class alist:
         return self.data.get(key)
 
     def keys(self):
-        return set(self.order)
+        return self.data.keys()
 
     def put(self, key, value):
+        if self.next_keys is not None and key not in self.data:
+            self._link(key, self.last, None)
         self.data[key] = value
-        if key not in self.order:
-            self.order.append(key)
 
 
 class SeriaNode:
+    __slots__ = ('_header', '_data_group', '_source', '_dirty', '_names', '_parent', '_classes', '_headers',
+                 '_watchers')
+
     def __init__(self, header: str, classname: str):
-        self.header = header
-        self.data_group = list()
-        self.data_group.append(alist({'m_classname': classname}))
+        self._header = header
+        self._data_group = list()
+        self._data_group.append(alist({'m_classname': sys.intern(classname)}))
+        # (source, brace index) of a node read with load(lazy=True)
+        self._source = None
+        # the node or a descendant was written since it was read, a new node has no original text
+        self._dirty = True
+        # attribute name -> group, see _name_index
+        self._names = None
+        self._parent = None
+        # classname -> child nodes and header -> child nodes, see _class_index and _header_index
+        self._classes = None
+        self._headers = None
+        # indexes that follow the edits of this subtree, see watch
+        self._watchers = None
+
+    @classmethod
+    def _empty(cls, header: str):
+        '''Create a node without any attribute group, not even m_classname.'''
+
+        node = cls.__new__(cls)
+        node._header = header
+        node._data_group = list()
+        node._source = None
+        node._dirty = True
+        node._names = None
+        node._parent = None
+        node._classes = None
+        node._headers = None
+        node._watchers = None
+        return node
+
+    @classmethod
+    def _lazy(cls, header: str, source, index: int):
+        '''Create a node whose content will be parsed from the source on first access.'''
+
+        node = cls.__new__(cls)
+        node._header = header
+        node._data_group = None
+        node._source = (source, index)
+        node._dirty = False
+        node._names = None
+        node._parent = None
+        node._classes = None
+        node._headers = None
+        node._watchers = None
+        return node
+
+    @property
+    def header(self) -> str:
+        '''The line before the opening curly brace, e.g. 'm_escadras=327'. None for the root node.'''
+
+        return self._header
+
+    @header.setter
+    def header(self, header: str):
+        self._header = header
+        if self._parent is not None:
+            self._parent._headers = None
+        self.mark_dirty()
+
+    @property
+    def dirty(self) -> bool:
+        '''Whether the node has to be written from its data. A clean node read with load(lazy=True) is dumped as
+        a copy of its original text, so a save only serializes the nodes on the path to an edit.'''
+
+        return self._dirty
+
+    def mark_dirty(self):
+        '''Mark the node and its ancestors as written. The write operations do this themselves,
+        it is only needed after editing data_group or a list value in place.'''
+
+        node = self
+        # the ancestors of a dirty node are already dirty
+        while node is not None and not node._dirty:
+            node._dirty = True
+            node = node._parent
+
+    @property
+    def data_group(self) -> list:
+        '''Attribute groups (alist) and child nodes in the order of the file.'''
+
+        if self._data_group is None:
+            self._materialize()
+        return self._data_group
+
+    @data_group.setter
+    def data_group(self, data_group: list):
+        self._data_group = data_group
+        self._names = None
+        self._nodes_changed()
+        for group in data_group:
+            if isinstance(group, SeriaNode):
+                group._parent = self
+        self.mark_dirty()
+
+    def _materialize(self):
+        '''Parse the content of a lazy node. Its child nodes stay lazy.'''
+
+        source, index = self._source
+        node = _build_tree(source.tokenize(index))
+        self._data_group = node._data_group
+        for group in self._data_group:
+            if isinstance(group, SeriaNode):
+                group._parent = self
+
+    def _name_index(self) -> dict:
+        '''Map each attribute name that appears after the first group to the first group that holds it.
+        The first group always holds m_classname and is checked directly, so a node with a single group needs no index.
+        The index is built on the first read and kept up to date by the attribute write operations.'''
+
+        names = self._names
+        if names is None:
+            names = dict()
+            for group in self.data_group[1:]:
+                if isinstance(group, alist):
+                    for name in group.keys():
+                        if name not in names:
+                            names[name] = group
+            self._names = names
+        return names
+
+    def _attribute_group(self, name: str):
+        '''Get the first group that holds an attribute, or None.'''
+
+        group = self.data_group[0]
+        if name in group:
+            return group
+        return self._name_index().get(name)
+
+    def _index_attribute(self, name: str, group, last: bool = False):
+        '''Record that a group holds an attribute, after the attribute has been added to the group.
+        @param last: the group is the last group, so a group that already holds the name comes first.'''
+
+        names = self._names
+        if names is None or group is self.data_group[0]:
+            return
+
+        indexed_group = names.get(name)
+        if indexed_group is None:
+            names[name] = group
+        elif indexed_group is not group and not last:
+            # the name is in several groups, let the next read work out which one comes first
+            self._names = None
 
     def _add_attribute(self, name: str, value: str):
         last_group = self.data_group[-1]
         if not isinstance(last_group, alist):
-            self.data_group.append(alist({name: value}))
+            last_group = alist({name: value})
+            self.data_group.append(last_group)
+            self._index_attribute(name, last_group, True)
         else:
             if name in last_group:
                 existing_value = last_group.get(name)
@@ -72,25 +405,106 @@ class SeriaNode:
                     last_group.put(name, [existing_value, value])
             else:
                 last_group.put(name, value)
+                self._index_attribute(name, last_group, True)
 
     def _add_child(self, node):
         if not isinstance(node, SeriaNode):
             logging.error('Child must be a SeriaNode')
             return
         self.data_group.append(node)
+        node._parent = self
+        self._nodes_changed()
+
+    def _nodes_changed(self):
+        '''Drop the child indexes after child nodes are added.'''
+
+        self._classes = None
+        self._headers = None
+
+    def watch(self, watcher):
+        '''Let a watcher follow the edits of the attribute and node write operations in this subtree.
+        The watcher is called with attribute_changed(node, name, old_value, new_value) and node_added(node).
+        A value is None when the attribute is added or deleted.'''
+
+        if self._watchers is None:
+            self._watchers = list()
+        self._watchers.append(watcher)
+
+    def unwatch(self, watcher):
+        '''Stop a watcher from following the edits of this subtree.'''
+
+        if self._watchers is not None and watcher in self._watchers:
+            self._watchers.remove(watcher)
+
+    def _attribute_changed(self, name: str, old_value, new_value):
+        '''Tell the watchers of this node and its ancestors that an attribute has been written.
+        Every write of an attribute goes through here, so the classname index of the parent is dropped here too.'''
+
+        self.mark_dirty()
+        if name == 'm_classname':
+            self._classname_changed()
+        node = self
+        while node is not None:
+            if node._watchers:
+                for watcher in node._watchers:
+                    watcher.attribute_changed(self, name, old_value, new_value)
+            node = node._parent
+
+    def _node_added(self, child):
+        '''Tell the watchers of this node and its ancestors that a child node has been added.'''
+
+        self.mark_dirty()
+        node = self
+        while node is not None:
+            if node._watchers:
+                for watcher in node._watchers:
+                    watcher.node_added(child)
+            node = node._parent
+
+    def _classname_changed(self):
+        '''Drop the classname index of the parent after m_classname of this node is written.'''
+
+        if self._parent is not None:
+            self._parent._classes = None
+
+    def _class_index(self) -> dict:
+        '''Map each classname to the child nodes with that classname, in order.
+        The index is built on the first read and dropped when child nodes or their classnames change.'''
+
+        classes = self._classes
+        if classes is None:
+            classes = dict()
+            for node in self.get_nodes():
+                classname = node.get_attribute('m_classname')
+                if classname in classes:
+                    classes[classname].append(node)
+                else:
+                    classes[classname] = [node]
+            self._classes = classes
+        return classes
+
+    def _header_index(self) -> dict:
+        '''Map each header to the child nodes with that header, in order.
+        Unlike the classname index, building it does not parse lazy child nodes.'''
+
+        headers = self._headers
+        if headers is None:
+            headers = dict()
+            for node in self.get_nodes():
+                if node._header in headers:
+                    headers[node._header].append(node)
+                else:
+                    headers[node._header] = [node]
+            self._headers = headers
+        return headers
 
     # attribute read operations
 
     def get_attribute(self, name: str):
         '''Get attribute value if the current node.'''
 
-        for group in self.data_group:
-            if isinstance(group, alist):
-                # assume that attribute only appear in consecutive order and will not spread accross groups
-                if name in group.keys():
-                    return group.get(name)
-
-        return None
+        group = self._attribute_group(name)
+        return None if group is None else group.get(name)
 
     def get_attributes(self):
         '''Get all attributes in the current node.'''
@@ -107,21 +521,13 @@ class SeriaNode:
     def has_attribute(self, name: str) -> bool:
         '''Check if the current node has an attribute.'''
 
-        for group in self.data_group:
-            if isinstance(group, alist):
-                if name in group.keys():
-                    return True
-
-        return False
+        return self._attribute_group(name) is not None
 
     def attribute_names(self) -> set:
         '''Get all attribute names in the current node.'''
 
-        names = set()
-
-        for group in self.data_group:
-            if isinstance(group, alist):
-                names = names.union(group.keys())
+        names = set(self.data_group[0].keys())
+        names.update(self._name_index())
 
         return names
 
@@ -133,14 +539,16 @@ class SeriaNode:
         A real example is the root node of the profile, which contains sections of attribute that spread accross the file.'''
 
         # existing attribute will be replaced with new value
-        for group in self.data_group:
-            if isinstance(group, alist):
-                if name in group.keys():
-                    group.put(name, value)
-                    return
+        group = self._attribute_group(name)
+        if group is not None:
+            old_value = group.get(name)
+            group.put(name, value)
+            self._attribute_changed(name, old_value, value)
+            return
 
         # new attribute will be add to the end of the current node
         self._add_attribute(name, value)
+        self._attribute_changed(name, None, value)
 
     def update_attribute(self, name: str, value: str):
         '''Update the attribute value of the root node.
@@ -151,8 +559,19 @@ class SeriaNode:
 
         for group in self.data_group:
             if isinstance(group, alist):
-                if name in group.keys():
+                if name in group:
+                    group_value = group.get(name)
                     group.put(name, value)
+                    self._attribute_changed(name, group_value, value)
+
+        # a list value is not indexed, see ValueIndex
+        index = self._watcher(ValueIndex) if isinstance(old_value, str) else None
+        if index is not None:
+            # only the child nodes reference the previous value, not the other attributes of this node
+            for node, location_name in index.locations(old_value, self):
+                if node is not self:
+                    node._replace_value(location_name, old_value, value)
+            return
 
         for group in self.data_group:
             if isinstance(group, SeriaNode):
@@ -160,15 +579,47 @@ class SeriaNode:
 
     def update_attribute_by_value(self, old_value: str, new_value: str):
         '''Update the attribute value by its old value. This applies to all child nodes and recursively.
-        If the attribute value is equal to the old value, it will be updated to the new value.'''
+        If the attribute value is equal to the old value, it will be updated to the new value.
+        With a ValueIndex on this node or an ancestor, only the attributes that hold the old value are visited.'''
+
+        index = self._watcher(ValueIndex) if isinstance(old_value, str) else None
+        if index is not None:
+            for node, name in index.locations(old_value, self):
+                node._replace_value(name, old_value, new_value)
+            return
+
+        # path[depth] is the node that holds the groups visited at that depth
+        path = []
+        for event, item, depth in traverse(self, (ENTER, GROUP)):
+            if event == ENTER:
+                del path[depth:]
+                path.append(item)
+                continue
+
+            for name, value in item:
+                if value == old_value:
+                    item.put(name, new_value)
+                    path[depth]._attribute_changed(name, old_value, new_value)
+
+    def _replace_value(self, name: str, old_value: str, new_value: str):
+        '''Replace the value of an attribute in every group where it holds the old value.'''
 
         for group in self.data_group:
-            if isinstance(group, alist):
-                for name, value in group:
-                    if value == old_value:
-                        group.put(name, new_value)
-            else:
-                group.update_attribute_by_value(old_value, new_value)
+            if isinstance(group, alist) and name in group and group.get(name) == old_value:
+                group.put(name, new_value)
+                self._attribute_changed(name, old_value, new_value)
+
+    def _watcher(self, watcher_class):
+        '''Get the nearest watcher of a class on this node or its ancestors, or None.'''
+
+        node = self
+        while node is not None:
+            if node._watchers:
+                for watcher in node._watchers:
+                    if isinstance(watcher, watcher_class):
+                        return watcher
+            node = node._parent
+        return None
 
     def put_attribute_before(self, name: str, value: str, before: str):
         '''Add an attribute before another attribute.
@@ -176,13 +627,12 @@ class SeriaNode:
         @param value: the value of the attribute to add.
         @param before: the name of the attribute before which the new attribute will be added.'''
 
-        for group in self.data_group:
-            if isinstance(group, alist):
-                if before in group.keys():
-                    index = group.index(before)
-
-                    group.insert(index, name, value)
-                    return
+        group = self._attribute_group(before)
+        if group is not None:
+            old_value = group.get(name)
+            group.insert_before(before, name, value)
+            self._index_attribute(name, group)
+            self._attribute_changed(name, old_value, value)
 
     def put_attribute_after(self, name: str, value: str, after: str):
         '''Add an attribute after another attribute.
@@ -190,23 +640,33 @@ class SeriaNode:
         @param value: the value of the attribute to add.
         @param after: the name of the attribute after which the new attribute will be added.'''
 
-        for group in self.data_group:
-            if isinstance(group, alist):
-                if after in group.keys():
-                    index = group.index(after)
-
-                    group.insert(index + 1, name, value)
-                    return
+        group = self._attribute_group(after)
+        if group is not None:
+            old_value = group.get(name)
+            group.insert_after(after, name, value)
+            self._index_attribute(name, group)
+            self._attribute_changed(name, old_value, value)
 
     def del_attribute(self, name: str):
         '''Delete an attribute from the current node.
         @param name: the name of the attribute to delete.'''
 
-        for group in self.data_group:
-            if isinstance(group, alist):
-                if name in group.keys():
-                    group.remove(name)
-                    return
+        group = self._attribute_group(name)
+        if group is None:
+            return
+
+        old_value = group.get(name)
+        group.remove(name)
+        self._attribute_changed(name, old_value, None)
+
+        names = self._names
+        if names is not None and names.get(name) is group:
+            # the name may still be held by a later group
+            del names[name]
+            for later_group in self.data_group[self.data_group.index(group) + 1:]:
+                if isinstance(later_group, alist) and name in later_group:
+                    names[name] = later_group
+                    break
 
     # node read operations
 
@@ -228,7 +688,14 @@ class SeriaNode:
     def get_node_by_class(self, classname: str):
         '''Get the first child node with the specified class name.'''
 
-        return self.get_node_if(lambda node: node.get_attribute('m_classname') == classname)
+        nodes = self._class_index().get(classname)
+        return None if nodes is None else nodes[0]
+
+    def get_node_by_header(self, header: str):
+        '''Get the first child node with the specified header, e.g. 'm_inventory=7'.'''
+
+        nodes = self._header_index().get(header)
+        return None if nodes is None else nodes[0]
 
     def get_nodes(self) -> list:
         '''Get all direct child nodes of the current node.
@@ -240,13 +707,19 @@ class SeriaNode:
         '''Get all child nodes with the specified class name.
         @return: a list of child nodes'''
 
-        return self.filter_nodes(lambda node: node.get_attribute('m_classname') == classname)
+        return list(self._class_index().get(classname, ()))
+
+    def get_nodes_by_header(self, header: str) -> list:
+        '''Get all child nodes with the specified header, e.g. 'm_escadras=327'.
+        @return: a list of child nodes'''
+
+        return list(self._header_index().get(header, ()))
 
     def node_classes(self) -> set:
         '''Get all classnames of child nodes.
         @return: a set of classnames.'''
 
-        return set(node.get_attribute('m_classname') for node in self.get_nodes())
+        return set(self._class_index())
 
     def node_count(self) -> int:
         '''Get the number of child nodes.'''
@@ -264,16 +737,25 @@ class SeriaNode:
         '''Add a child node to the end of the current node.'''
 
         self.data_group.append(node)
+        node._parent = self
+        self._nodes_changed()
+        self._node_added(node)
 
     def put_node_before(self, node, before):
         '''Add a child node before another child node.'''
 
         self.data_group.insert(self.data_group.index(before), node)
+        node._parent = self
+        self._nodes_changed()
+        self._node_added(node)
 
     def put_node_after(self, node, after):
         '''Add a child node after another child node.'''
 
         self.data_group.insert(self.data_group.index(after) + 1, node)
+        node._parent = self
+        self._nodes_changed()
+        self._node_added(node)
 
     def put_node_before_index(self, node, index):
         '''Add a child node before another child node by index.'''
@@ -306,17 +788,802 @@ class SeriaNode:
 
         return [mapper(node) for node in self.get_nodes()]
 
+    # descendant operations
+
+    def walk(self, prune=None, max_depth: int = None):
+        '''Iterate over the current node and its descendants in the order of the file, without building lists.
+        @param prune: a function called with each node, the descendants of a node are skipped when it returns True,
+        e.g. lambda node: node.get_attribute('m_classname') == 'Mesh'.
+        @param max_depth: the depth of the deepest nodes to visit, the child nodes have depth 1.'''
+
+        if prune is not None:
+            prune_node = prune
+            prune = lambda node, depth: prune_node(node)
+
+        for _, node, _ in traverse(self, prune=prune, max_depth=max_depth):
+            yield node
+
+    def descendants(self, classname: str = None, prune=None, max_depth: int = None):
+        '''Iterate over the descendants of the current node in the order of the file, see walk.
+        @param classname: only yield the descendants with this m_classname.'''
+
+        nodes = self.walk(prune, max_depth)
+        # the current node comes first
+        next(nodes)
+        for node in nodes:
+            if classname is None or node.get_attribute('m_classname') == classname:
+                yield node
+
+    def find_all(self, predicate, max_depth: int = None, prune=None):
+        '''Iterate over the descendants of the current node that satisfy a predicate function, see walk.'''
+
+        for node in self.descendants(prune=prune, max_depth=max_depth):
+            if predicate(node):
+                yield node
+
+    # path operations
+
+    def select(self, path: str) -> list:
+        '''Select nodes or attribute values with a path, see compile_path.
+        @return: a list of the matching nodes, or of their values if the path ends with @attribute.'''
+
+        return compile_path(path).select(self)
+
+    def select_one(self, path: str):
+        '''Select the first node or attribute value that matches a path, see compile_path.
+        @return: the first match, or None.'''
+
+        return compile_path(path).select_one(self)
+
+
+def _values(value) -> tuple:
+    '''Get the values of an attribute as a tuple, an attribute that appears several times holds a list.'''
+
+    if value is None:
+        return ()
+    if isinstance(value, list):
+        return tuple(value)
+    return (value,)
+
+
+class IdIndex:
+    '''Index of the m_id values in a tree and of the attributes that reference them.
+    It is built in a single pass and follows later edits made through the SeriaNode write operations.'''
+
+    def __init__(self, root: SeriaNode, references=ID_REFERENCES):
+        '''@param root: the node whose subtree is indexed.
+        @param references: names of the attributes that reference an m_id.'''
+
+        self.root = root
+        self.references = frozenset(references)
+        # id -> nodes that define it, more than one node means a duplicate id
+        self.definitions = dict()
+        # id -> list of (node, attribute name) that reference it
+        self.referrers = dict()
+        self.duplicates = set()
+        self.dangling = set()
+        # count of each numeric id and a max-heap of them, for next_id
+        self._numbers = dict()
+        self._heap = list()
+
+        self.node_added(root)
+        root.watch(self)
+
+    def close(self):
+        '''Stop following the edits of the tree.'''
+
+        self.root.unwatch(self)
+
+    # queries
+
+    def get_node(self, id: str) -> SeriaNode:
+        '''Get the node that defines an id, or None.'''
+
+        nodes = self.definitions.get(id)
+        return nodes[0] if nodes else None
+
+    def get_references(self, id: str) -> list:
+        '''Get the (node, attribute name) pairs that reference an id.'''
+
+        return list(self.referrers.get(id, ()))
+
+    def is_unique(self, id: str) -> bool:
+        '''Check that an id is defined by at most one node.'''
+
+        return id not in self.duplicates
+
+    def has_dangling(self) -> bool:
+        '''Check if any reference points to an id that no node defines.'''
+
+        return len(self.dangling) > 0
+
+    def dangling_references(self) -> dict:
+        '''Get the references to ids that no node defines.
+        @return: id -> list of (node, attribute name).'''
+
+        return {id: list(self.referrers[id]) for id in self.dangling}
+
+    def next_id(self) -> str:
+        '''Get an id greater than every numeric id in the tree.'''
+
+        heap = self._heap
+        # drop ids that are no longer defined
+        while heap and -heap[0] not in self._numbers:
+            heapq.heappop(heap)
+        return str(-heap[0] + 1) if heap else '1'
+
+    # watcher
+
+    def attribute_changed(self, node: SeriaNode, name: str, old_value, new_value):
+        if name == ID_ATTRIBUTE:
+            for value in _values(old_value):
+                self._remove_definition(value, node)
+            for value in _values(new_value):
+                self._add_definition(value, node)
+        elif name in self.references:
+            for value in _values(old_value):
+                self._remove_reference(value, node, name)
+            for value in _values(new_value):
+                self._add_reference(value, node, name)
+
+    def node_added(self, node: SeriaNode):
+        for node in node.walk():
+            for group in node.data_group:
+                if isinstance(group, alist):
+                    for name, value in group:
+                        self.attribute_changed(node, name, None, value)
+
+    def _add_definition(self, id: str, node: SeriaNode):
+        nodes = self.definitions.setdefault(id, [])
+        nodes.append(node)
+        if len(nodes) > 1:
+            self.duplicates.add(id)
+        self.dangling.discard(id)
+
+        try:
+            number = int(id)
+        except ValueError:
+            return
+        count = self._numbers.get(number, 0)
+        self._numbers[number] = count + 1
+        if count == 0:
+            heapq.heappush(self._heap, -number)
+
+    def _remove_definition(self, id: str, node: SeriaNode):
+        nodes = self.definitions.get(id)
+        if not nodes or node not in nodes:
+            return
+
+        nodes.remove(node)
+        if len(nodes) < 2:
+            self.duplicates.discard(id)
+        if len(nodes) == 0:
+            del self.definitions[id]
+            if id in self.referrers:
+                self.dangling.add(id)
+
+        try:
+            number = int(id)
+        except ValueError:
+            return
+        count = self._numbers.pop(number) - 1
+        if count > 0:
+            self._numbers[number] = count
+
+    def _add_reference(self, id: str, node: SeriaNode, name: str):
+        self.referrers.setdefault(id, []).append((node, name))
+        if id not in self.definitions:
+            self.dangling.add(id)
+
+    def _remove_reference(self, id: str, node: SeriaNode, name: str):
+        referrers = self.referrers.get(id)
+        if not referrers:
+            return
+
+        for index, (referrer, referrer_name) in enumerate(referrers):
+            if referrer is node and referrer_name == name:
+                del referrers[index]
+                break
+
+        if len(referrers) == 0:
+            del self.referrers[id]
+            self.dangling.discard(id)
+
+
+class ValueIndex:
+    '''Reverse index from attribute values to the attributes that hold them in a subtree.
+    With the index on a node or one of its ancestors, update_attribute and update_attribute_by_value
+    only visit the attributes that hold the old value instead of the whole subtree.
+    Only single values are indexed, an attribute that appears several times (a list) never equals a value.
+    It follows later edits made through the SeriaNode write operations.'''
+
+    def __init__(self, root: SeriaNode):
+        self.root = root
+        # value -> {(node, attribute name): number of groups of the node that hold the value}
+        self.values = dict()
+
+        self.node_added(root)
+        root.watch(self)
+
+    def close(self):
+        '''Stop following the edits of the tree.'''
+
+        self.root.unwatch(self)
+
+    def locations(self, value: str, within: SeriaNode = None) -> list:
+        '''Get the (node, attribute name) pairs that hold a value.
+        @param within: only return the attributes of this node and its descendants.'''
+
+        locations = self.values.get(value)
+        if not locations:
+            return []
+        if within is None or within is self.root:
+            return list(locations)
+
+        result = list()
+        for location in locations:
+            node = location[0]
+            while node is not None and node is not within:
+                node = node._parent
+            if node is within:
+                result.append(location)
+        return result
+
+    # watcher
+
+    def attribute_changed(self, node: SeriaNode, name: str, old_value, new_value):
+        if isinstance(old_value, str):
+            locations = self.values.get(old_value)
+            if locations is not None:
+                location = (node, name)
+                count = locations.pop(location, 0) - 1
+                if count > 0:
+                    locations[location] = count
+                elif len(locations) == 0:
+                    del self.values[old_value]
+
+        if isinstance(new_value, str):
+            locations = self.values.setdefault(new_value, dict())
+            location = (node, name)
+            locations[location] = locations.get(location, 0) + 1
+
+    def node_added(self, node: SeriaNode):
+        for node in node.walk():
+            for group in node.data_group:
+                if isinstance(group, alist):
+                    for name, value in group:
+                        self.attribute_changed(node, name, None, value)
+
+
+def _defined_ids(node: SeriaNode) -> list:
+    '''Get the m_id values defined in a subtree, in the order of the file.'''
+
+    ids = list()
+    for node in node.walk():
+        for group in node.data_group:
+            if isinstance(group, alist):
+                ids.extend(_values(group.get(ID_ATTRIBUTE)))
+    return ids
+
+
+def _clone(node: SeriaNode, id_map: dict) -> SeriaNode:
+    '''Copy a subtree in a single traversal, replacing the ids found in id_map in m_id and its references.'''
+
+    def clone_group(group):
+        data = dict()
+        for name, value in group:
+            if name in _ID_NAMES:
+                if isinstance(value, list):
+                    value = [id_map.get(v, v) for v in value]
+                else:
+                    value = id_map.get(value, value)
+            data[name] = value
+        return alist(data)
+
+    root = SeriaNode(node.header, node.get_attribute('m_classname'))
+    pending = [(node, root)]
+
+    while len(pending) > 0:
+        source, target = pending.pop()
+        data_group = list()
+        for group in source.data_group:
+            if isinstance(group, alist):
+                data_group.append(clone_group(group))
+            else:
+                child = SeriaNode(group.header, group.get_attribute('m_classname'))
+                data_group.append(child)
+                pending.append((group, child))
+        target.data_group = data_group
+
+    return root
+
+
+def import_designs(profile: SeriaNode, designs: list, escadra: SeriaNode = None) -> list:
+    '''Import ship designs into a profile with new, collision-free ids.
+    The ids of all designs are worked out at once, above every id in the profile, then each design is copied in a
+    single traversal that rewrites m_id and the attributes referencing it (ID_REFERENCES). The same design can be given
+    several times, each copy gets its own ids. The designs themselves are not modified.
+    Attributes that depend on the game state, such as the Creature fields of a flagship, are left to the caller.
+    @param profile: the root node of the profile.
+    @param designs: root Node nodes of design files.
+    @param escadra: if given, each copy becomes a ship of this Escadra node: it gets the header 'm_children=7',
+    m_state and m_master_id, and is added after the last ship of the escadra.
+    @return: the list of copied nodes, in the order of designs.'''
+
+    # an IdIndex on the profile already knows the largest id, otherwise read the ids in one pass
+    id_index = profile._watcher(IdIndex)
+    if id_index is not None:
+        next_id = int(id_index.next_id())
+    else:
+        numbers = [int(id) for id in _defined_ids(profile) if id.lstrip('-').isdigit()]
+        next_id = max(numbers) + 1 if numbers else 1
+
+    design_ids = dict()
+    copies = list()
+    for design in designs:
+        if id(design) not in design_ids:
+            design_ids[id(design)] = _defined_ids(design)
+
+        id_map = dict()
+        for old_id in design_ids[id(design)]:
+            if old_id not in id_map:
+                id_map[old_id] = str(next_id)
+                next_id += 1
+
+        copies.append(_clone(design, id_map))
+
+    if escadra is not None:
+        escadra_id = escadra.get_attribute('m_id')
+        ships = escadra.get_nodes_by_header('m_children=7')
+        last_ship = ships[-1] if ships else None
+
+        for ship in copies:
+            ship.header = 'm_children=7'
+            # same place as in the ships of a profile: m_name, m_state, m_master_id
+            if not ship.has_attribute('m_state') and ship.has_attribute('m_name'):
+                ship.put_attribute_after('m_state', '2', 'm_name')
+            if ship.has_attribute('m_master_id') or not ship.has_attribute('m_state'):
+                ship.set_attribute('m_master_id', escadra_id)
+            else:
+                ship.put_attribute_after('m_master_id', escadra_id, 'm_state')
+
+            if last_ship is None:
+                escadra.add_node(ship)
+            else:
+                escadra.put_node_after(ship, last_ship)
+            last_ship = ship
+
+    return copies
+
+
+class SeriaPath:
+    '''A compiled path, see compile_path.'''
+
+    __slots__ = ('path', 'steps', 'attribute')
+
+    def __init__(self, path: str, steps: tuple, attribute: str = None):
+        self.path = path
+        # (axis, classname or None for any classname, ((attribute name, value or None), ...))
+        self.steps = steps
+        self.attribute = attribute
+
+    def __repr__(self) -> str:
+        return f'SeriaPath({self.path!r})'
+
+    def iterate(self, node: SeriaNode):
+        '''Yield the matches of the path from a node in the order of the file, only as far as they are read.'''
+
+        nodes = (node,)
+        for axis, classname, predicates in self.steps:
+            nodes = _path_step(nodes, axis, classname, predicates)
+
+        if self.attribute is None:
+            return nodes
+        return _path_attribute(nodes, self.attribute)
+
+    def select(self, node: SeriaNode) -> list:
+        '''Get all matches of the path from a node.'''
+
+        return list(self.iterate(node))
+
+    def select_one(self, node: SeriaNode):
+        '''Get the first match of the path from a node, or None.'''
+
+        return next(self.iterate(node), None)
+
+
+def _path_step(nodes, axis: int, classname: str, predicates: tuple):
+    '''Yield the child or descendant nodes of some nodes that match a step of a path.'''
+
+    seen = set() if axis == _DESCENDANT else None
+
+    for node in nodes:
+        if axis == _CHILD:
+            if classname is None:
+                candidates = node.get_nodes()
+            else:
+                candidates = node._class_index().get(classname, ())
+        else:
+            candidates = node.descendants(classname)
+
+        for candidate in candidates:
+            if seen is not None:
+                # nested matches of the previous step reach the same descendants
+                if id(candidate) in seen:
+                    continue
+                seen.add(id(candidate))
+
+            for name, value in predicates:
+                attribute_value = candidate.get_attribute(name)
+                if value is None:
+                    if attribute_value is None:
+                        break
+                elif attribute_value != value and not (isinstance(attribute_value, list) and value in attribute_value):
+                    break
+            else:
+                yield candidate
+
+
+def _path_attribute(nodes, name: str):
+    '''Yield the values of an attribute of some nodes, skipping the nodes without it.'''
+
+    for node in nodes:
+        value = node.get_attribute(name)
+        if value is not None:
+            yield value
+
+
+@functools.lru_cache(maxsize=256)
+def compile_path(path: str) -> SeriaPath:
+    '''Compile a path that selects nodes relative to a node. Compiled paths are cached.
+
+    A path is a list of steps separated by '/' for child nodes or by '//' for descendant nodes at any depth.
+    A path that starts with '//' searches all descendants. A step is a classname, or '*' for any classname,
+    followed by any number of conditions on attributes: [name] or [name=value], the value may be quoted.
+    A path can end with @name to select the values of an attribute instead of the nodes.
+    For example 'Frame/Body[m_name=COMBRIDGE]/Creature@m_ship_name' or '//Item[m_oid]'.
+
+    @raise ValueError: if the path is not valid.'''
+
+    position = 0
+    axis = _CHILD
+    if path.startswith('//'):
+        axis = _DESCENDANT
+        position = 2
+    elif path.startswith('/'):
+        position = 1
+
+    steps = []
+    attribute = None
+
+    while True:
+        match = _PATH_STEP_REGEX.match(path, position)
+        if match is None:
+            raise ValueError(f'Expected a classname at position {position} of path: {path}')
+        classname = None if match.group() == '*' else sys.intern(match.group())
+        position = match.end()
+
+        predicates = []
+        match = _PATH_PREDICATE_REGEX.match(path, position)
+        while match is not None:
+            name, double_quoted, single_quoted, plain = match.groups()
+            value = next((v for v in (double_quoted, single_quoted, plain) if v is not None), None)
+            predicates.append((name, value))
+            position = match.end()
+            match = _PATH_PREDICATE_REGEX.match(path, position)
+
+        steps.append((axis, classname, tuple(predicates)))
+
+        if path.startswith('//', position):
+            axis = _DESCENDANT
+            position += 2
+        elif path.startswith('/', position):
+            axis = _CHILD
+            position += 1
+        else:
+            break
+
+    match = _PATH_ATTRIBUTE_REGEX.match(path, position)
+    if match is not None:
+        attribute = match.group(1)
+        position = match.end()
+
+    if position != len(path):
+        raise ValueError(f'Unexpected {path[position]!r} at position {position} of path: {path}')
+
+    return SeriaPath(path, tuple(steps), attribute)
+
 
 def _match_attribute(input: str):
     '''Match an attribute and its value from a line of text.
     @return: a tuple of the attribute and its value, or None if no match.'''
 
-    match_result = re.match(ATTRIBUTE_PATTERN + '=' + VALUE_PATTERN, input)
+    match_result = _ATTRIBUTE_REGEX.match(input)
     if match_result:
         return match_result.group(1), match_result.group(2)
     return None, None
 
 
+def _split_attribute(line: str):
+    '''Split a stripped line into an attribute and its value on the first '='.
+    This gives the same result as _match_attribute without going through the regex engine.
+    @return: a tuple of the attribute and its value, or None if no match.'''
+
+    name, separator, value = line.partition('=')
+    # an attribute name only holds name characters, so nothing is left after stripping them
+    if separator and name and name[0] in _NAME_START_CHARS and not name.strip(_NAME_CHARS):
+        return name, value
+    return None, None
+
+
+def _tokenize(lines):
+    '''Turn lines of a seria file into tokens in a single forward pass.
+    Each line is held back for one step, because the line before a '{' is the header of the next node.
+    @return: a generator of (token, name, value) tuples. For _NODE_START, name is the header (or None).
+    For _TEXT, name is the raw line. For _SUBTREE (only from _LazySource), name is a lazy node.'''
+
+    pending = None
+
+    for line in lines:
+        line = line.strip()
+
+        if line == '{':
+            yield _NODE_START, pending, None
+            pending = None
+            continue
+
+        if pending is not None:
+            name, value = _split_attribute(pending)
+            if name is None:
+                yield _TEXT, pending, None
+            else:
+                yield _ATTRIBUTE, name, value
+
+        if line == '}':
+            pending = None
+            yield _NODE_END, None, None
+        else:
+            pending = line
+
+    if pending is not None:
+        name, value = _split_attribute(pending)
+        if name is None:
+            yield _TEXT, pending, None
+        else:
+            yield _ATTRIBUTE, name, value
+
+
+def _build_tree(tokens) -> SeriaNode:
+    '''Build a SeriaNode tree from the tokens of _tokenize.
+    @return: the root node of the tree.'''
+
+    logger = logging.getLogger('seria.load')
+
+    parent_nodes = list()
+    header_line = None
+    node = None
+
+    for token, name, value in tokens:
+        if token == _ATTRIBUTE:
+            if name == 'm_classname':
+                logger.info('new node: %s', value)
+
+                node = SeriaNode(header_line, value)
+
+                if len(parent_nodes) > 0:
+                    parent_nodes[-1]._add_child(node)
+
+                parent_nodes.append(node)
+            else:
+                if len(value) <= _POOLED_VALUE_LENGTH:
+                    value = _VALUE_POOL.setdefault(value, value)
+                parent_nodes[-1]._add_attribute(sys.intern(name), value)
+        elif token == _NODE_END:
+            # the last '}' will give the last node which is the root node and return it at the end
+            node = parent_nodes.pop()
+        elif token == _SUBTREE:
+            parent_nodes[-1]._add_child(name)
+        elif token == _NODE_START:
+            # the line before the curly brace is belong the next node
+            # e.g. 'm_escadras=327' is belong to node 'Escadra'
+            if name is not None:
+                header_line = name
+        else:
+            node = parent_nodes[-1]
+
+            if node.data_group[0].get('m_classname') == 'Mesh':
+                node._add_attribute('_mesh', name)
+
+    return node
+
+
+def _parse_events(tokens):
+    '''Turn the tokens of _tokenize into the events of iterparse, the same way as _build_tree builds nodes.
+    Only the m_classname of the enclosing nodes is kept, so memory only grows with the depth of the tree.'''
+
+    classnames = list()
+    header_line = None
+
+    for token, name, value in tokens:
+        if token == _ATTRIBUTE:
+            if name == 'm_classname':
+                classnames.append(value)
+                yield START_NODE, header_line, value
+            else:
+                yield ATTRIBUTE, name, value
+        elif token == _NODE_END:
+            if len(classnames) == 0:
+                raise ValueError('Unmatched closing brace')
+            yield END_NODE, None, classnames.pop()
+        elif token == _NODE_START:
+            if name is not None:
+                header_line = name
+        elif len(classnames) > 0 and classnames[-1] == 'Mesh':
+            yield MESH_LINE, name, None
+
+
+class _LazySource:
+    '''Raw bytes of a seria file with the position of every curly brace, used by lazy nodes.
+    The prescan matches each '{' with its '}', so the range of a subtree is known without parsing it.
+    The bytes are only decoded from cp1251 when a node is parsed or dumped.'''
+
+    def __init__(self, buffer, filepath: str = None):
+        # bytes or a read-only mmap of the file
+        self.buffer = buffer
+        self.filepath = filepath
+        # start of each brace line, the end of each brace line and the index of the matching brace
+        self.starts = list()
+        self.ends = list()
+        self.pairs = list()
+        self.root = None
+
+        stack = list()
+        for match in _BRACE_BYTES_REGEX.finditer(buffer):
+            index = len(self.starts)
+            self.starts.append(match.start())
+            self.ends.append(match.end())
+
+            if match.group(1) == b'{':
+                stack.append(index)
+                self.pairs.append(None)
+            else:
+                if len(stack) == 0:
+                    raise ValueError(f'Unmatched closing brace at {match.start()}')
+                open_index = stack.pop()
+                self.pairs[open_index] = index
+                self.pairs.append(open_index)
+
+                # the last top level node is the root node, same as the eager parser
+                if len(stack) == 0:
+                    self.root = open_index
+
+        if len(stack) > 0 or self.root is None:
+            raise ValueError('Unbalanced curly braces')
+
+    def detach(self):
+        '''Copy a mapped file into memory and unmap it, so that the file can be overwritten.'''
+
+        if isinstance(self.buffer, mmap.mmap):
+            buffer = self.buffer
+            self.buffer = bytes(buffer)
+            buffer.close()
+
+    def close(self):
+        '''Unmap a mapped file without a copy, the nodes of the source can no longer be parsed or dumped.'''
+
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+            self.buffer = None
+
+    def _header(self, index: int):
+        '''Find the header line of the node opened by a brace.
+        @return: a tuple of the header (or None) and the start of the node in the buffer.'''
+
+        start = self.starts[index]
+        if start == 0:
+            return None, start
+
+        line_start = self.buffer.rfind(b'\n', 0, start - 1) + 1
+        line = self.buffer[line_start:start - 1].decode('cp1251').strip()
+        if line in ('{', '}'):
+            return None, start
+        return line, line_start
+
+    def node(self, index: int) -> SeriaNode:
+        '''Create a lazy node for the subtree opened by a brace.'''
+
+        header, _ = self._header(index)
+        return SeriaNode._lazy(header, self, index)
+
+    def span(self, index: int):
+        '''Get the range of the subtree opened by a brace, from its header line to its closing brace.'''
+
+        _, start = self._header(index)
+        return start, self.ends[self.pairs[index]]
+
+    def tokenize(self, index: int):
+        '''Tokenize the subtree opened by a brace, with each direct child node given as a lazy node.
+        Only the lines of the node itself are decoded, not the lines of its children.'''
+
+        start, end = self.span(index)
+        close_index = self.pairs[index]
+        child_index = index + 1
+
+        while child_index < close_index:
+            child_start, child_end = self.span(child_index)
+            yield from _tokenize(self._lines(start, child_start))
+            yield _SUBTREE, self.node(child_index), None
+
+            # skip the newline after the closing brace of the child
+            start = self.buffer.find(b'\n', child_end) + 1
+            child_index = self.pairs[child_index] + 1
+
+        yield from _tokenize(self._lines(start, end))
+
+    def _lines(self, start: int, end: int) -> list:
+        lines = self.buffer[start:end].decode('cp1251').split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        return lines
+
+    def dump_str(self, index: int) -> str:
+        '''Get the original text of the subtree opened by a brace.'''
+
+        start, end = self.span(index)
+        # same newlines as a file opened in text mode
+        return self.buffer[start:end].decode('cp1251').replace('\r\n', '\n')
+
+
+def traverse(node: SeriaNode, events: tuple = (ENTER,), prune=None, max_depth: int = None):
+    '''Walk a subtree in the order of the file with an explicit stack, so that the depth is only limited by memory.
+    @param events: the visits to yield. ENTER visits a node before its children (pre-order),
+    LEAVE visits a node after its children (post-order) and GROUP visits each attribute group of a node.
+    @param prune: a function called with (node, depth) after a node is entered, the children of the node
+    are skipped when it returns True. A pruned node is neither parsed nor entered further, but it is still left.
+    @param max_depth: the depth of the deepest nodes to visit, the given node has depth 0.
+    @return: a generator of (event, node or group, depth), the depth of a group is the depth of its node.'''
+
+    enter = ENTER in events
+    leave = LEAVE in events
+    groups = GROUP in events
+
+    if enter:
+        yield ENTER, node, 0
+    if (max_depth is not None and max_depth <= 0) or (prune is not None and prune(node, 0)):
+        if leave:
+            yield LEAVE, node, 0
+        return
+
+    if max_depth is None:
+        max_depth = -1
+
+    stack = [(node, iter(node.data_group))]
+    push = stack.append
+    while stack:
+        parent, items = stack[-1]
+        depth = len(stack)
+
+        # the iterator of each node on the stack resumes after the child that was entered last
+        for item in items:
+            if isinstance(item, alist):
+                if groups:
+                    yield GROUP, item, depth - 1
+                continue
+
+            if enter:
+                yield ENTER, item, depth
+            if depth == max_depth or (prune is not None and prune(item, depth)):
+                if leave:
+                    yield LEAVE, item, depth
+            else:
+                push((item, iter(item.data_group)))
+                break
+        else:
+            stack.pop()
+            if leave:
+                yield LEAVE, parent, depth - 1
+
+
 def tree(node: SeriaNode, max_depth: int = None) -> str:
     '''Print a SeriaNode in a tree-like format.'''
 
@@ -327,110 +1594,555 @@ def tree(node: SeriaNode, max_depth: int = None) -> str:
 
     output = []
 
-    def _print_node(node, depth):
-        output.append('  ' * (depth - 1) + node.get_attribute('m_classname'))
+    for _, child, depth in traverse(node, max_depth=None if max_depth is None else max(max_depth - 1, 0)):
+        output.append('  ' * depth + child.get_attribute('m_classname'))
 
-        if max_depth is None or depth < max_depth:
-            for child in node.get_nodes():
-                _print_node(child, depth + 1)
+    return '\n'.join(output)
 
-    _print_node(node, 1)
 
-    return '\n'.join(output)
+def _is_clean(node: SeriaNode, depth: int) -> bool:
+    return not node._dirty
 
 
-def dump_str(node: SeriaNode) -> str:
-    '''Dump a SeriaNode to a string.'''
+def write(node: SeriaNode, file):
+    '''Write a SeriaNode to a text file object, one buffered chunk at a time.
 
-    output = []
+    @param node: the node to write
+    @param file: a file object opened in text mode
+    '''
 
-    if node.header is not None:
-        output.append(node.header)
-    output.append('{')
+    chunk = []
+    append = chunk.append
 
-    for group in node.data_group:
-        if isinstance(group, alist):
-            for name, value in group:
+    # a node read with load(lazy=True) that has not been written is copied from its original text
+    for event, item, _ in traverse(node, (ENTER, LEAVE, GROUP), _is_clean):
+        if event == GROUP:
+            for name, value in item:
                 if name == '_mesh':
-                    output.extend(f'{v}' for v in value)
+                    for v in value:
+                        append(f'{v}\n')
+                elif isinstance(value, list):
+                    for v in value:
+                        append(f'{name}={v}\n')
                 else:
-                    if isinstance(value, list):
-                        output.extend(f'{name}={v}' for v in value)
-                    else:
-                        output.append(f'{name}={value}')
-        else:
-            output.append(dump_str(group))
+                    append(f'{name}={value}\n')
+
+            if len(chunk) >= _WRITE_CHUNK_SIZE:
+                file.write(''.join(chunk))
+                chunk.clear()
+        elif item._dirty:
+            if event == LEAVE:
+                append('}\n')
+            elif item._header is None:
+                append('{\n')
+            else:
+                append(f'{item._header}\n{{\n')
+        elif event == ENTER:
+            source, index = item._source
+            append(source.dump_str(index))
+            append('\n')
 
-    output.append('}')
-    return '\n'.join(output)
+            if len(chunk) >= _WRITE_CHUNK_SIZE:
+                file.write(''.join(chunk))
+                chunk.clear()
+
+    file.write(''.join(chunk))
+
+
+def dump_str(node: SeriaNode) -> str:
+    '''Dump a SeriaNode to a string.'''
+
+    output = io.StringIO()
+    write(node, output)
+    return output.getvalue()[:-1]
+
+
+def _open_temporary(filepath: str):
+    '''Create a new file next to a file, with the permissions of the file if it exists.
+    @return: a tuple of the path and the descriptor of the new file.'''
+
+    directory, name = os.path.split(os.path.abspath(filepath))
+    attempt = 0
+    while True:
+        temporary = os.path.join(directory, f'.{name}.{os.getpid()}.{attempt}.tmp')
+        try:
+            fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            break
+        except FileExistsError:
+            attempt += 1
+
+    try:
+        os.chmod(temporary, os.stat(filepath).st_mode & 0o7777)
+    except FileNotFoundError:
+        pass
+    return temporary, fd
+
+
+def _rotate_backups(filepath: str, backups: int):
+    '''Keep copies of a file as <file>.1.bak (the newest) to <file>.<backups>.bak (the oldest).'''
 
+    if not os.path.exists(filepath):
+        return
 
-def dump(node: SeriaNode, filepath: str):
-    '''Dump a SeriaNode to a file.'''
+    for number in range(backups - 1, 0, -1):
+        backup = f'{filepath}.{number}.bak'
+        if os.path.exists(backup):
+            os.replace(backup, f'{filepath}.{number + 1}.bak')
+    # a copy, so that the file is never missing
+    shutil.copy2(filepath, f'{filepath}.1.bak')
+
+
+def _sync_directory(directory: str):
+    '''Make a rename in a directory durable. Directories cannot be opened on Windows.'''
+
+    if os.name == 'nt':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def dump(node: SeriaNode, filepath: str, backups: int = 0):
+    '''Dump a SeriaNode to a file.
+    The node is written to a temporary file in the same directory, which replaces the file once it is on disk,
+    so a crash or an error while writing leaves the previous file untouched. A .seria_enc file is written encrypted.
+    @param backups: the number of previous versions to keep as <file>.1.bak to <file>.<backups>.bak.
+    @return: True if the file was written, False if the error was logged.'''
 
     logger = logging.getLogger('seria.dump')
 
+    # replace the file a link points to, not the link
+    target = os.path.realpath(filepath)
+
+    # a mapped file cannot be replaced on Windows, elsewhere the mapping keeps the previous file readable
+    if os.name == 'nt':
+        for source in list(_mapped_sources.pop(target, ())):
+            source.detach()
+
+    temporary = None
     try:
-        with open(filepath, 'w', encoding='cp1251') as file:
-            file.write(dump_str(node) + '\n')
+        temporary, fd = _open_temporary(target)
+        if is_encrypted(target):
+            file = open_encrypted(fd, 'w', _WRITE_BUFFER_SIZE)
+        else:
+            file = open(fd, 'w', encoding='cp1251', buffering=_WRITE_BUFFER_SIZE)
+        with file:
+            write(node, file)
+            file.flush()
+            os.fsync(file.fileno())
+
+        if backups > 0:
+            _rotate_backups(target, backups)
+        os.replace(temporary, target)
+        temporary = None
+        _sync_directory(os.path.dirname(target))
     except IOError:
         logger.error(f'Could not open file: {filepath}')
+        return False
+    finally:
+        if temporary is not None and os.path.exists(temporary):
+            os.remove(temporary)
+    return True
+
+
+@functools.lru_cache(maxsize=1)
+def _key_lanes(count: int):
+    '''Constants for _keystream, packed into big ints with one little-endian 32 bit lane per byte.
+    @return: a tuple of the step of each lane from the first lane (i * _KEY_STEP), a 1 in each lane,
+    _KEY_MASK in each lane and 0xff in each lane.'''
+
+    steps = struct.pack(f'<{count}I', *((index * _KEY_STEP) & _KEY_MASK for index in range(count)))
+    ones = int.from_bytes(struct.pack(f'<{count}I', *(1,) * count), 'little')
+    return int.from_bytes(steps, 'little'), ones, ones * _KEY_MASK, ones * 0xff
+
+
+def _keystream(state: int, length: int) -> bytes:
+    '''Make the keystream of up to _KEY_LANES bytes from a state of the generator.
+    Every byte is computed at once: each lane of a big int holds the generator state of one byte,
+    the state of a lane only needs 23 bits, so a 32 bit lane never carries into the next one.'''
+
+    steps, ones, state_mask, byte_mask = _key_lanes(_KEY_LANES)
+    if length < _KEY_LANES:
+        # only the lanes that are needed, so that a small chunk is cheap
+        lanes = (1 << (length * 32)) - 1
+        steps &= lanes
+        ones &= lanes
+        state_mask &= lanes
+        byte_mask &= lanes
+
+    states = (steps + (state & _KEY_MASK) * ones) & state_mask
+    keys = (states ^ (states >> 15)) & byte_mask
+    return keys.to_bytes(length * 4, 'little')[::4]
+
+
+def decrypt(data: bytes, state: int = _KEY_SEED) -> bytes:
+    '''Decrypt the bytes of a .seria_enc file, each byte is xored with (b ^ (b >> 15)) & 0xff,
+    where b starts at _KEY_SEED and grows by _KEY_STEP modulo 2 ** 32 for each byte.
+    @param state: the generator state of the first byte.
+    @return: the decrypted bytes.'''
+
+    output = list()
+    for start in range(0, len(data), _KEY_LANES):
+        chunk = data[start:start + _KEY_LANES]
+        key = _keystream(state, len(chunk))
+        output.append((int.from_bytes(chunk, 'little') ^ int.from_bytes(key, 'little')).to_bytes(len(chunk), 'little'))
+        state = (state + _KEY_LANES * _KEY_STEP) & 0xffffffff
+    return b''.join(output)
+
+
+class SeriaCipher:
+    '''The keystream of a .seria_enc file from its first byte on, for a file that is read or written in chunks.
+    Encryption and decryption are the same xor, so update does both. The generator state carries over
+    from one chunk to the next, the chunks can have any size.'''
+
+    __slots__ = ('state',)
+
+    def __init__(self, state: int = _KEY_SEED):
+        self.state = state
+
+    def update(self, data: bytes) -> bytes:
+        '''Encrypt or decrypt the next chunk of a file.'''
+
+        output = decrypt(data, self.state)
+        self.state = (self.state + len(data) * _KEY_STEP) & 0xffffffff
+        return output
+
+
+class _EncryptedFile(io.RawIOBase):
+    '''A binary file that decrypts the bytes that are read from it and encrypts the bytes that are written to it.'''
+
+    def __init__(self, file):
+        self.file = file
+        self.cipher = SeriaCipher()
+
+    def readable(self) -> bool:
+        return self.file.readable()
+
+    def writable(self) -> bool:
+        return self.file.writable()
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def readinto(self, buffer) -> int:
+        data = self.file.read(len(buffer))
+        if not data:
+            return 0
+        buffer[:len(data)] = self.cipher.update(data)
+        return len(data)
+
+    def write(self, data) -> int:
+        # the cipher has moved past the whole chunk, so all of it has to be written
+        output = memoryview(self.cipher.update(bytes(data)))
+        while len(output) > 0:
+            written = self.file.write(output)
+            if written is None:
+                raise BlockingIOError(errno.EAGAIN, 'Could not write the encrypted data')
+            output = output[written:]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                super().close()
+            finally:
+                self.file.close()
+
+
+def is_encrypted(filepath: str) -> bool:
+    '''Check if a file is encrypted by its suffix.'''
+
+    return filepath.lower().endswith(_ENCRYPTED_SUFFIX)
+
+
+def open_encrypted(file, mode: str = 'r', buffering: int = _KEY_LANES):
+    '''Open an encrypted file like the built-in open, the bytes are decrypted or encrypted one chunk at a time.
+    @param file: the path or the descriptor of the file.
+    @param mode: 'r' or 'w' for text in cp1251, 'rb' or 'wb' for bytes.
+    @param buffering: the size of the chunks.
+    @return: a file object.'''
+
+    if mode not in ('r', 'w', 'rb', 'wb'):
+        raise ValueError(f'Invalid mode: {mode}')
+
+    raw = _EncryptedFile(open(file, mode[0] + 'b', buffering=0))
+    buffered = io.BufferedReader(raw, buffering) if mode[0] == 'r' else io.BufferedWriter(raw, buffering)
+    if mode.endswith('b'):
+        return buffered
+    return io.TextIOWrapper(buffered, encoding='cp1251')
+
+
+def _open(filepath: str, mode: str = 'r'):
+    '''Open a seria file, an encrypted one is decrypted on the fly.'''
+
+    if is_encrypted(filepath):
+        return open_encrypted(filepath, mode)
+    return open(filepath, mode, encoding=None if mode.endswith('b') else 'cp1251')
 
 
-def load(filepath: str) -> SeriaNode:
-    '''Load a SeriaNode from a file.
+def load(filepath: str, lazy: bool = False, cache=None) -> SeriaNode:
+    '''Load a SeriaNode from a file, a .seria_enc file is decrypted while it is read.
+    @param lazy: map the file into memory and only parse a node when it is accessed for the first time.
+    Nodes that are never accessed are dumped as their original text.
+    @param cache: a TreeCache that keeps the parsed tree of the file, it is not used for a lazy load.
     @return: the root node of the SeriaNode, or None if the file could not be opened.'''
 
     logger = logging.getLogger('seria.load')
 
+    if cache is not None and not lazy:
+        return cache.load(filepath)
+
     try:
-        with open(filepath, 'r', encoding='cp1251') as file:
-            lines = file.readlines()
+        with _open(filepath, 'rb' if lazy else 'r') as file:
+            if not lazy:
+                return _build_tree(_tokenize(file))
+
+            if is_encrypted(filepath):
+                # the nodes are parsed from the decrypted bytes
+                buffer = file.read()
+            else:
+                try:
+                    buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # an empty file cannot be mapped
+                    buffer = file.read()
     except IOError:
         logger.error(f'Could not open file: {filepath}')
         return None
 
-    parent_nodes = list()
-    header_line = None
-    node = None
+    try:
+        source = _LazySource(buffer, filepath)
+    except ValueError as error:
+        logger.warning(f'Could not prescan file, load all nodes instead: {error}')
+        text = buffer[:].decode('cp1251')
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+        return _build_tree(_tokenize(io.StringIO(text)))
 
-    for index, line in enumerate(lines):
-        line = line.strip()
+    if isinstance(buffer, mmap.mmap):
+        _mapped_sources.setdefault(os.path.realpath(filepath), weakref.WeakSet()).add(source)
 
-        if line == '{':
-            continue
-        elif line == '}':
-            # the last '}' will give the last node which is the root node and return it at the end
-            node = parent_nodes.pop()
-        else:
-            # the line before the curly brace is belong the next node
-            # e.g. 'm_escadras=327' is belong to node 'Escadra'
-            next_index = index + 1
-            if next_index < len(lines):
-                next_line = lines[next_index].strip()
-                if next_line == '{':
-                    header_line = line
-                    continue
+    return source.node(source.root)
 
-            name, value = _match_attribute(line)
 
-            if name == 'm_classname':
-                logger.info(f'new node: {value}')
+def _lazy_sources(node: SeriaNode) -> set:
+    '''Get the lazy sources of the nodes of a tree, without parsing any node.'''
 
-                node = SeriaNode(header_line, value)
+    sources = set()
+    for _, item, _ in traverse(node, prune=lambda item, depth: item._data_group is None):
+        if item._source is not None:
+            sources.add(item._source[0])
+    return sources
 
-                if len(parent_nodes) > 0:
-                    parent_nodes[-1]._add_child(node)
 
-                parent_nodes.append(node)
-            elif name is None:
-                node = parent_nodes[-1]
+def detach(node: SeriaNode):
+    '''Copy the file of a lazily loaded tree into memory and unmap it, so that other programs can replace the file.
+    The tree stays usable.'''
 
-                if node.data_group[0].get('m_classname') == 'Mesh':
-                    node._add_attribute('_mesh', line)
-            else:
-                logger.debug(f'new attribute: {name} = {value}')
+    for source in _lazy_sources(node):
+        source.detach()
+
+
+def close(node: SeriaNode):
+    '''Unmap the file of a lazily loaded tree once the tree is no longer used,
+    instead of waiting for the garbage collector. Nodes that were not parsed yet can no longer be read,
+    and the tree can no longer be dumped.'''
+
+    for source in _lazy_sources(node):
+        source.close()
+
+
+def iterparse(filepath: str):
+    '''Parse a file into a stream of events without building any node, one line at a time.
+    A .seria_enc file is decrypted one chunk at a time.
+    The events come in the order of the file as (event, name, value) tuples:
+    (START_NODE, header, classname) when a node starts, the header is the line before its '{' (or None),
+    (ATTRIBUTE, name, value) for each attribute of the node except m_classname,
+    (MESH_LINE, line, None) for each line of mesh data in a Mesh node,
+    and (END_NODE, None, classname) when the node ends.
+    @return: a generator of events. It raises IOError if the file could not be opened,
+    and ValueError on a closing brace without a node.'''
+
+    with _open(filepath) as file:
+        yield from _parse_events(_tokenize(file))
+
+
+def _snapshot(node: SeriaNode) -> list:
+    '''Flatten a tree into records that marshal can store: (header,) enters a node,
+    (names, values) is an attribute group and None leaves a node.'''
+
+    records = list()
+    for event, item, _ in traverse(node, (ENTER, LEAVE, GROUP)):
+        if event == GROUP:
+            records.append((tuple(name for name, _ in item), tuple(value for _, value in item)))
+        elif event == ENTER:
+            records.append((item.header,))
+        else:
+            records.append(None)
+    return records
 
-                parent_nodes[-1]._add_attribute(name, value)
+
+def _restore(records: list) -> SeriaNode:
+    '''Build a tree from the records of _snapshot.'''
+
+    parent_nodes = list()
+    node = None
+
+    for record in records:
+        if record is None:
+            node = parent_nodes.pop()
+        elif len(record) == 1:
+            node = SeriaNode._empty(record[0])
+            if len(parent_nodes) > 0:
+                parent = parent_nodes[-1]
+                parent._data_group.append(node)
+                node._parent = parent
+            parent_nodes.append(node)
+        else:
+            names, values = record
+            group = alist()
+            group.data = dict(zip(map(sys.intern, names), values))
+            parent_nodes[-1]._data_group.append(group)
 
     return node
+
+
+class TreeCache:
+    '''Opt-in cache of parsed trees in a directory, so that a file that did not change is not parsed again.
+    An entry is found by the path of the file and holds a marshal snapshot of the tree.
+    It is used while the file has the same size and either the same modification time or the same content hash.
+    The least recently used entries are removed once the entries take more than max_size bytes.'''
+
+    def __init__(self, directory: str, max_size: int = 256 * 2 ** 20):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, filepath: str) -> str:
+        name = hashlib.blake2b(os.path.realpath(filepath).encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.directory, name + _CACHE_SUFFIX)
+
+    @staticmethod
+    def _digest(filepath: str) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(_WRITE_BUFFER_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def load(self, filepath: str) -> SeriaNode:
+        '''Load a file like seria.load, from its entry if the entry is still valid.
+        @return: the root node, or None if the file could not be opened.'''
+
+        logger = logging.getLogger('seria.cache')
+
+        try:
+            status = os.stat(filepath)
+        except OSError:
+            logger.error(f'Could not open file: {filepath}')
+            return None
+
+        entry = self._entry(filepath)
+        digest = None
+        try:
+            with open(entry, 'rb') as file:
+                # the header is read on its own, marshal.load reads a file object in small pieces
+                header_size = int.from_bytes(file.read(4), 'little')
+                version, size, mtime, entry_digest = marshal.loads(file.read(header_size))
+                if version == (_CACHE_VERSION, marshal.version) and size == status.st_size:
+                    if mtime != status.st_mtime_ns:
+                        digest = self._digest(filepath)
+                    if digest is None or digest == entry_digest:
+                        node = self._read_tree(file)
+                        # the modification time of an entry orders the entries for eviction
+                        os.utime(entry)
+                        if digest is not None:
+                            self._store(entry, status, digest, node)
+                        return node
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, ValueError, TypeError, IndexError) as error:
+            logger.warning(f'Could not read cache entry {entry}: {error}')
+
+        node = load(filepath)
+        if node is not None:
+            self._store(entry, status, digest or self._digest(filepath), node)
+            self._evict()
+        return node
+
+    @staticmethod
+    def _read_tree(file) -> SeriaNode:
+        # the objects of a tree are all kept, collecting garbage while they are created only costs time
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return _restore(marshal.loads(file.read()))
+        finally:
+            if enabled:
+                gc.enable()
+
+    def _store(self, entry: str, status, digest: str, node: SeriaNode):
+        logger = logging.getLogger('seria.cache')
+
+        temporary = None
+        try:
+            temporary, fd = _open_temporary(entry)
+            header = marshal.dumps(((_CACHE_VERSION, marshal.version), status.st_size, status.st_mtime_ns, digest))
+            with open(fd, 'wb') as file:
+                file.write(len(header).to_bytes(4, 'little'))
+                file.write(header)
+                file.write(marshal.dumps(_snapshot(node)))
+            os.replace(temporary, entry)
+            temporary = None
+        except (OSError, ValueError) as error:
+            logger.warning(f'Could not write cache entry {entry}: {error}')
+        finally:
+            if temporary is not None and os.path.exists(temporary):
+                os.remove(temporary)
+
+    def _entries(self) -> list:
+        '''Get (modification time, size, path) of each entry.'''
+
+        entries = list()
+        for name in os.listdir(self.directory):
+            if name.endswith(_CACHE_SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime_ns, status.st_size, path))
+        return entries
+
+    def _evict(self):
+        '''Remove the least recently used entries until the entries fit in max_size.'''
+
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def invalidate(self, filepath: str):
+        '''Remove the entry of a file, e.g. after changing it without changing its size or modification time.'''
+
+        try:
+            os.remove(self._entry(filepath))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        '''Remove all entries.'''
+
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
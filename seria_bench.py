@@ -0,0 +1,940 @@
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import seria
+import seria_cli
+
+__author__ = 'Max'
+__version__ = '0.1.0'
+
+
+def _print_help():
+    print('''Usage: python seria_bench.py [option] [<seria_file>]
+Options:
+    -load [<seria_file>]     | Compare the legacy and the current seria.load
+    -lazy [<seria_file>]     | Compare eager and lazy seria.load when only m_cash is read
+    -attributes              | Micro-benchmark the SeriaNode attribute API with the legacy and the current alist
+    -memory [<seria_file>]   | Report the memory used per node by the legacy and the current loader
+    -dump [<seria_file>]     | Compare the legacy recursive dump and the current streaming dump
+    -save [<seria_file>]     | Compare a plain overwrite with the atomic seria.dump, with and without backups
+    -cache [<seria_file>]    | Compare seria.load with a cold and a warm TreeCache
+    -jobs [<count>|<dir>]    | Time seria_cli -values over <count> generated files or the files of a directory with 1 to N processes
+    -scan [<seria_file>]     | Compare the line by line regex scan and the block scan of seria_cli -attributes and -values
+    -iterparse [<seria_file>]| Compare seria.load with seria.tree and the streaming seria_cli -tree on time and memory
+    -decrypt [<seria_enc>]   | Compare the legacy per byte loop of main.dec_seria with seria.decrypt
+    -treeview [<seria_file>] | Compare the eager and the lazy tree view of main.py on a mocked Treeview widget
+    -check [<seria_file>]    | Check that lazy and eager trees dump the same after random edits, that the block scan
+                             | matches the regex scan and that seria.decrypt matches the per byte loop
+    -deep                    | Compare the legacy recursive and the current iterative dump_str, tree and cascade on deep trees
+Without a seria file, a synthetic profile of about 4 MB is generated for the run.
+Example:
+    python seria_bench.py -load profile.seria''')
+
+
+def make_profile(escadras: int = 400, seed: int = 0) -> str:
+    '''Generate the text of a synthetic profile.
+    It follows the layout of a real profile: squadrons with ship designs, cities, NPCs and the ammunition depot.
+    @param escadras: the number of Escadra nodes, each one adds about 10 KB.'''
+
+    rng = random.Random(seed)
+    lines = ['{', 'm_classname=Profile', 'm_scores=1000', 'm_cash=25000', 'nextCreatureId=300']
+
+    def new_id():
+        return str(rng.randrange(-2 ** 63, 2 ** 63))
+
+    def add_body(master_id, depth):
+        body_id = new_id()
+        lines.extend(['m_children=15', '{', 'm_classname=Body', 'm_code=15', f'm_id={body_id}',
+                      f'm_name={rng.choice(["COMBRIDGE", "HULL", "ENGINE", "GUN", "BOMB"])}',
+                      'm_state=2', f'm_master_id={master_id}', f'm_owner_id={master_id}',
+                      f'm_pos={rng.random():.6f} {rng.random():.6f}', 'm_visible=true'])
+        lines.extend(f'm_param={rng.randrange(100)}' for _ in range(3))
+        lines.extend(['m_mesh=1', '{', 'm_classname=Mesh', 'm_code=1'])
+        lines.extend(' '.join(str(rng.randrange(1000)) for _ in range(12)) for _ in range(6))
+        lines.append('}')
+        if depth == 0:
+            lines.extend(['m_children=3', '{', 'm_classname=Creature', f'm_id={new_id()}',
+                          f'm_master_id={body_id}', f'm_ship_name=Ship{rng.randrange(1000)}',
+                          'm_playable=true', '}'])
+        lines.append('}')
+
+    for index in range(escadras):
+        escadra_id = new_id()
+        lines.extend(['m_escadras=327', '{', 'm_classname=Escadra', 'm_code=327', f'm_id={escadra_id}',
+                      f'm_name={"MARK" if index == 0 else "ESCADRA" + str(index)}', 'm_alignment=1'])
+        for _ in range(2):
+            node_id = new_id()
+            lines.extend(['m_children=7', '{', 'm_classname=Node', 'm_code=7', f'm_id={node_id}',
+                          f'm_master_id={escadra_id}'])
+            frame_id = new_id()
+            lines.extend(['m_frame=7', '{', 'm_classname=Frame', f'm_id={frame_id}', f'm_master_id={node_id}'])
+            add_body(frame_id, 0)
+            lines.append('}')
+            for _ in range(8):
+                add_body(node_id, 1)
+            lines.extend(['m_joints=9', '{', 'm_classname=Joint', f'm_A.id={new_id()}', f'm_B.id={new_id()}',
+                          '}'])
+            lines.append('}')
+        lines.extend(['m_inventory=7', '{', 'm_classname=Node', 'm_code=7', f'm_id={new_id()}'])
+        for _ in range(3):
+            lines.extend(['m_children=15', '{', 'm_classname=Body', 'm_code=15', f'm_id={new_id()}',
+                          'm_oid=ITEM_BOMB', f'm_count={rng.randrange(1, 50)}', '}'])
+        lines.append('}')
+        lines.append('}')
+        # attributes of the root node are spread between its child nodes
+        lines.append(f'm_escadra_stat={index}')
+
+    for index in range(escadras // 4):
+        lines.extend(['m_locations=5', '{', 'm_classname=Location', f'm_name=CITY{index}',
+                      f'm_codename=C{index}', '}'])
+        lines.extend(['m_npcs=6', '{', 'm_classname=NPC', f'm_name=NPC{index}', 'm_fullname=John Doe', '}'])
+
+    for index in (8, 13, 14, 15, 16, 30, 31, 35):
+        lines.extend(['m_items=2199023255555', '{', 'm_classname=Item', 'm_code=2199023255555',
+                      f'm_index={index}', f'm_count={rng.randrange(1, 500)}', '}'])
+
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def _legacy_load(filepath: str) -> seria.SeriaNode:
+    '''seria.load as of version 0.2.0, kept as the baseline of the -load benchmark.'''
+
+    with open(filepath, 'r', encoding='cp1251') as file:
+        lines = file.readlines()
+
+    parent_nodes = list()
+    header_line = None
+    node = None
+
+    for index, line in enumerate(lines):
+        line = line.strip()
+
+        if line == '{':
+            continue
+        elif line == '}':
+            node = parent_nodes.pop()
+        else:
+            next_index = index + 1
+            if next_index < len(lines):
+                next_line = lines[next_index].strip()
+                if next_line == '{':
+                    header_line = line
+                    continue
+
+            match_result = re.match(seria.ATTRIBUTE_PATTERN + '=' + seria.VALUE_PATTERN, line)
+            name, value = match_result.groups() if match_result else (None, None)
+
+            if name == 'm_classname':
+                node = seria.SeriaNode(header_line, value)
+                if len(parent_nodes) > 0:
+                    parent_nodes[-1]._add_child(node)
+                parent_nodes.append(node)
+            elif name is None:
+                node = parent_nodes[-1]
+                if node.data_group[0].get('m_classname') == 'Mesh':
+                    node._add_attribute('_mesh', line)
+            else:
+                parent_nodes[-1]._add_attribute(name, value)
+
+    return node
+
+
+class _LegacyAlist:
+    '''alist as of version 0.2.0, kept as the baseline of the -attributes benchmark.'''
+
+    def __init__(self, data: dict = None):
+        self.data = data or dict()
+        self.order = list(data.keys())
+
+    def __iter__(self):
+        for key in self.order:
+            yield key, self.get(key)
+
+    def __contains__(self, key) -> bool:
+        return key in self.keys()
+
+    def index(self, key) -> int:
+        return self.order.index(key)
+
+    def insert(self, index, key, value):
+        self.data[key] = value
+        self.order.insert(index, key)
+
+    # positional insertion as SeriaNode calls it now, on top of the legacy index and insert
+    def insert_before(self, before, key, value):
+        self.insert(self.index(before), key, value)
+
+    def insert_after(self, after, key, value):
+        self.insert(self.index(after) + 1, key, value)
+
+    def remove(self, key):
+        del self.data[key]
+        self.order.remove(key)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def keys(self):
+        return set(self.order)
+
+    def put(self, key, value):
+        self.data[key] = value
+        if key not in self.order:
+            self.order.append(key)
+
+
+def _measure(function, *args, repeat: int = 3) -> float:
+    '''Run a function several times and return the best wall time in seconds.'''
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _with_profile(filepath, action):
+    '''Call the action with the given file, or with a generated profile if no file is given.'''
+
+    if filepath is not None:
+        return action(filepath)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'profile.seria')
+        with open(filepath, 'w', encoding='cp1251') as file:
+            file.write(make_profile())
+        return action(filepath)
+
+
+def bench_load(filepath: str):
+    '''Compare the legacy and the current seria.load on the same file.'''
+
+    size = os.path.getsize(filepath)
+    legacy = _measure(_legacy_load, filepath)
+    current = _measure(seria.load, filepath)
+
+    same = seria.dump_str(_legacy_load(filepath)) == seria.dump_str(seria.load(filepath))
+
+    print(f'File: {filepath} ({size / 2 ** 20:.1f} MB)')
+    print(f'legacy load:  {legacy:.3f}s')
+    print(f'current load: {current:.3f}s ({legacy / current:.1f}x)')
+    print(f'identical tree: {same}')
+
+
+def _peak_memory(function, *args) -> int:
+    '''Run a function and return the peak of memory allocated by Python during the run in bytes.'''
+
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_lazy(filepath: str):
+    '''Compare eager and lazy seria.load on a session that reads and writes m_cash.'''
+
+    def session(lazy):
+        node = seria.load(filepath, lazy=lazy)
+        node.set_attribute('m_cash', node.get_attribute('m_cash'))
+        return seria.dump_str(node)
+
+    size = os.path.getsize(filepath)
+    eager_time = _measure(session, False)
+    lazy_time = _measure(session, True)
+    eager_memory = _peak_memory(session, False)
+    lazy_memory = _peak_memory(session, True)
+
+    print(f'File: {filepath} ({size / 2 ** 20:.1f} MB)')
+    print(f'eager: {eager_time:.3f}s, peak {eager_memory / 2 ** 20:.1f} MB')
+    print(f'lazy:  {lazy_time:.3f}s, peak {lazy_memory / 2 ** 20:.1f} MB')
+    print(f'identical dump: {session(False) == session(True)}')
+
+
+def bench_attributes(fields: int = 200, number: int = 2000):
+    '''Time the SeriaNode attribute API on a node with many fields, with the legacy and the current alist.'''
+
+    def make_node():
+        node = seria.SeriaNode(None, 'Creature')
+        for index in range(fields):
+            node._add_attribute(f'm_field{index}', str(index))
+        return node
+
+    def put_and_delete(node):
+        node.put_attribute_after('m_extra', '1', f'm_field{fields // 2}')
+        node.del_attribute('m_extra')
+
+    last = f'm_field{fields - 1}'
+    operations = [
+        ('get_attribute', lambda node: node.get_attribute(last)),
+        ('has_attribute', lambda node: node.has_attribute('m_missing')),
+        ('set_attribute', lambda node: node.set_attribute(last, '0')),
+        ('put_attribute_after + del_attribute', put_and_delete),
+    ]
+
+    current_alist = seria.alist
+    results = dict()
+    for label, alist_class in (('legacy', _LegacyAlist), ('current', current_alist)):
+        seria.alist = alist_class
+        try:
+            node = make_node()
+            build = timeit.timeit(make_node, number=number // 100) / (number // 100)
+            results[label] = [('build node', build)] + [
+                (name, timeit.timeit(lambda: operation(node), number=number) / number)
+                for name, operation in operations]
+        finally:
+            seria.alist = current_alist
+
+    print(f'SeriaNode with {fields} attributes, time per call:')
+    for (name, legacy), (_, current) in zip(results['legacy'], results['current']):
+        print(f'{name:<38} legacy {legacy * 1e6:9.2f}us  current {current * 1e6:9.2f}us')
+
+
+def _count_nodes(node: seria.SeriaNode) -> int:
+    count = 0
+    nodes = [node]
+    while len(nodes) > 0:
+        count += 1
+        nodes.extend(nodes.pop().get_nodes())
+    return count
+
+
+def bench_memory(filepath: str):
+    '''Report the memory held by a loaded tree per node, measured with tracemalloc.
+    The legacy figure loads without interning and with the legacy alist.'''
+
+    def traced_size(function):
+        tracemalloc.start()
+        try:
+            node = function(filepath)
+            return node, tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    current_alist = seria.alist
+    seria.alist = _LegacyAlist
+    try:
+        node, legacy = traced_size(_legacy_load)
+    finally:
+        seria.alist = current_alist
+    del node
+
+    node, current = traced_size(seria.load)
+    count = _count_nodes(node)
+
+    print(f'File: {filepath} ({os.path.getsize(filepath) / 2 ** 20:.1f} MB, {count} nodes)')
+    print(f'legacy:  {legacy / 2 ** 20:6.1f} MB, {legacy / count:7.1f} bytes per node')
+    print(f'current: {current / 2 ** 20:6.1f} MB, {current / count:7.1f} bytes per node')
+
+
+def _legacy_dump_str(node: seria.SeriaNode) -> str:
+    '''The recursive dump_str that joins the text of every child before returning.'''
+
+    output = []
+
+    if node.header is not None:
+        output.append(node.header)
+    output.append('{')
+
+    for group in node.data_group:
+        if isinstance(group, seria.alist):
+            for name, value in group:
+                if name == '_mesh':
+                    output.extend(f'{v}' for v in value)
+                else:
+                    if isinstance(value, list):
+                        output.extend(f'{name}={v}' for v in value)
+                    else:
+                        output.append(f'{name}={value}')
+        else:
+            output.append(_legacy_dump_str(group))
+
+    output.append('}')
+    return '\n'.join(output)
+
+
+def _legacy_dump(node: seria.SeriaNode, filepath: str):
+    '''Write the legacy dump_str to a file the way the legacy seria.dump did.'''
+
+    with open(filepath, 'w', encoding='cp1251') as file:
+        file.write(_legacy_dump_str(node) + '\n')
+
+
+def bench_dump(filepath: str):
+    '''Compare the legacy and the current seria.dump of the same tree, in time and peak memory.'''
+
+    node = seria.load(filepath)
+    size = os.path.getsize(filepath)
+
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_path = os.path.join(directory, 'legacy.seria')
+        current_path = os.path.join(directory, 'current.seria')
+
+        legacy = _measure(_legacy_dump, node, legacy_path)
+        current = _measure(seria.dump, node, current_path)
+        legacy_memory = _peak_memory(_legacy_dump, node, legacy_path)
+        current_memory = _peak_memory(seria.dump, node, current_path)
+
+        with open(legacy_path, 'rb') as legacy_file, open(current_path, 'rb') as current_file:
+            same = legacy_file.read() == current_file.read()
+
+    print(f'File: {filepath} ({size / 2 ** 20:.1f} MB)')
+    print(f'legacy dump:  {legacy:.3f}s, peak {legacy_memory / 2 ** 20:.1f} MB')
+    print(f'current dump: {current:.3f}s, peak {current_memory / 2 ** 20:.1f} MB')
+    print(f'identical output: {same}')
+
+
+def _plain_dump(node: seria.SeriaNode, filepath: str):
+    '''Overwrite a file in place with the streaming writer, without a temporary file or fsync.'''
+
+    with open(filepath, 'w', encoding='cp1251', buffering=seria._WRITE_BUFFER_SIZE) as file:
+        seria.write(node, file)
+
+
+def bench_save(filepath: str):
+    '''Compare a plain overwrite with the atomic seria.dump of the same tree.'''
+
+    node = seria.load(filepath)
+    size = os.path.getsize(filepath)
+
+    with tempfile.TemporaryDirectory() as directory:
+        target = os.path.join(directory, 'profile.seria')
+
+        plain = _measure(_plain_dump, node, target, repeat=5)
+        atomic = _measure(seria.dump, node, target, repeat=5)
+        backup = _measure(seria.dump, node, target, 3, repeat=5)
+
+        with open(filepath, 'rb') as source_file, open(target, 'rb') as target_file:
+            same = source_file.read() == target_file.read()
+
+    print(f'File: {filepath} ({size / 2 ** 20:.1f} MB)')
+    print(f'plain overwrite:      {plain:.3f}s')
+    print(f'atomic dump:          {atomic:.3f}s')
+    print(f'atomic dump, 3 .bak:  {backup:.3f}s')
+    print(f'identical output: {same}')
+
+
+def make_deep(depth: int, width: int = 1) -> seria.SeriaNode:
+    '''Build a tree where each node has a few attributes and a chain of the given depth below each of width children.'''
+
+    root = seria.SeriaNode(None, 'Node')
+    for branch in range(width):
+        node = root
+        for level in range(depth):
+            child = seria.SeriaNode(f'm_children={level}', 'Body')
+            child.set_attribute('m_id', str(branch * depth + level))
+            child.set_attribute('m_master_id', str(branch * depth + level - 1))
+            node.add_node(child)
+            node = child
+    return root
+
+
+def _legacy_tree(node: seria.SeriaNode) -> str:
+    '''The recursive tree without a depth limit.'''
+
+    output = []
+
+    def _print_node(node, depth):
+        output.append('  ' * (depth - 1) + node.get_attribute('m_classname'))
+        for child in node.get_nodes():
+            _print_node(child, depth + 1)
+
+    _print_node(node, 1)
+    return '\n'.join(output)
+
+
+def _legacy_update_by_value(node: seria.SeriaNode, old_value: str, new_value: str):
+    '''The recursive update_attribute_by_value without a ValueIndex.'''
+
+    for group in node.data_group:
+        if isinstance(group, seria.alist):
+            for name, value in group:
+                if value == old_value:
+                    group.put(name, new_value)
+        else:
+            _legacy_update_by_value(group, old_value, new_value)
+
+
+def bench_deep():
+    '''Compare the legacy recursive walks with seria.traverse on trees of growing depth.
+    A legacy walk that exceeds the recursion limit is reported as failed.'''
+
+    def run(function, *args):
+        try:
+            return f'{_measure(function, *args) * 1000:8.1f}ms'
+        except RecursionError:
+            return '  RecursionError'
+
+    print(f'recursion limit: {sys.getrecursionlimit()}')
+    print('tree                     walk          legacy        current')
+    for depth, width in ((50, 200), (500, 20), (5000, 2)):
+        node = make_deep(depth, width)
+        label = f'depth {depth} x {width}'
+        for name, legacy, current in (
+                ('dump_str', _legacy_dump_str, seria.dump_str),
+                ('tree', _legacy_tree, seria.tree),
+                ('cascade', lambda node: _legacy_update_by_value(node, '7', '7'),
+                 lambda node: node.update_attribute_by_value('7', '7'))):
+            print(f'{label:<24} {name:<9} {run(legacy, node)} {run(current, node)}')
+
+
+def bench_cache(filepath: str):
+    '''Compare seria.load with a cold TreeCache (parse and store) and a warm one (restore the snapshot).'''
+
+    size = os.path.getsize(filepath)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = seria.TreeCache(directory)
+
+        def cold():
+            cache.clear()
+            return seria.load(filepath, cache=cache)
+
+        plain = _measure(seria.load, filepath)
+        cold_time = _measure(cold)
+        warm_time = _measure(seria.load, filepath, False, cache)
+        entry_size = sum(size for _, size, _ in cache._entries())
+
+        same = seria.dump_str(seria.load(filepath)) == seria.dump_str(seria.load(filepath, cache=cache))
+
+    print(f'File: {filepath} ({size / 2 ** 20:.1f} MB), cache entry {entry_size / 2 ** 20:.1f} MB')
+    print(f'load:            {plain:.3f}s')
+    print(f'cold cache load: {cold_time:.3f}s')
+    print(f'warm cache load: {warm_time:.3f}s ({plain / warm_time:.1f}x)')
+    print(f'identical tree: {same}')
+
+
+def bench_jobs(files: int = 8):
+    '''Time seria_cli -values m_name over several synthetic profiles with 1 process up to one per CPU.'''
+
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(files):
+            with open(os.path.join(directory, f'profile{seed}.seria'), 'w', encoding='cp1251') as file:
+                file.write(make_profile(seed=seed))
+        bench_jobs_directory(directory)
+
+
+def bench_jobs_directory(directory: str):
+    '''Time seria_cli -values m_name over the seria files of a directory with 1 process up to one per CPU.'''
+
+    filepaths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                       if name.lower().endswith(('.seria', '.seria_enc')))
+    if len(filepaths) == 0:
+        print(f'No seria files in directory: {directory}')
+        return
+
+    jobs_list = sorted({1, 2, 4, os.cpu_count() or 1})
+
+    process_file = seria_cli.functools.partial(seria_cli.file_values, 'm_name')
+    expected = list(seria_cli.process_files(filepaths, process_file))
+
+    size = sum(os.path.getsize(filepath) for filepath in filepaths)
+    print(f'{len(filepaths)} files of {size / 2 ** 20:.1f} MB in total, {os.cpu_count()} CPUs')
+    single = None
+    for jobs in jobs_list:
+        elapsed = _measure(lambda: list(seria_cli.process_files(filepaths, process_file, jobs)), repeat=2)
+        same = list(seria_cli.process_files(filepaths, process_file, jobs)) == expected
+        single = single or elapsed
+        print(f'-jobs {jobs}: {elapsed:.3f}s ({single / elapsed:.1f}x), same results in order: {same}')
+
+
+def _legacy_scan(filepath: str, attribute_name: str = None) -> set:
+    '''The line by line scan of seria_cli with a regex per line, for -attributes or for -values of an attribute.'''
+
+    result_set = set()
+    with open(filepath, 'r', encoding='cp1251') as file:
+        for line in file:
+            attribute, value = seria._match_attribute(line)
+            if attribute_name is None:
+                if attribute is not None:
+                    result_set.add(attribute)
+            elif attribute == attribute_name:
+                result_set.add(value)
+    return result_set
+
+
+def bench_scan(filepath: str):
+    '''Compare the legacy and the current scan of seria_cli -attributes and -values m_name.'''
+
+    size = os.path.getsize(filepath)
+    print(f'File: {filepath} ({size / 2 ** 20:.1f} MB)')
+
+    for label, legacy, current in (
+            ('-attributes', lambda: _legacy_scan(filepath), lambda: seria_cli.file_attributes(filepath)),
+            ('-values m_name', lambda: _legacy_scan(filepath, 'm_name'),
+             lambda: seria_cli.file_values('m_name', filepath))):
+        legacy_time = _measure(legacy)
+        current_time = _measure(current)
+        same = legacy() == current()
+        print(f'{label:<15} legacy {legacy_time:.3f}s, current {current_time:.3f}s '
+              f'({legacy_time / current_time:.1f}x), same result: {same}')
+
+
+def _load_tree(filepath: str):
+    with open(filepath + '-tree.txt', 'w') as file:
+        file.write(seria.tree(seria.load(filepath)))
+
+
+def bench_iterparse(filepath: str):
+    '''Compare seria_cli -tree before and after it runs on seria.iterparse, on time and peak memory.'''
+
+    size = os.path.getsize(filepath)
+    print(f'File: {filepath} ({size / 2 ** 20:.1f} MB)')
+
+    load_time = _measure(_load_tree, filepath)
+    load_memory = _peak_memory(_load_tree, filepath)
+    with open(filepath + '-tree.txt') as file:
+        expected = file.read()
+
+    stream_time = _measure(seria_cli.file_tree, filepath)
+    stream_memory = _peak_memory(seria_cli.file_tree, filepath)
+    with open(filepath + '-tree.txt') as file:
+        same = file.read() == expected
+    os.remove(filepath + '-tree.txt')
+
+    print(f'load and tree: {load_time:.3f}s, peak {load_memory / 2 ** 20:.1f} MB')
+    print(f'iterparse:     {stream_time:.3f}s, peak {stream_memory / 2 ** 20:.2f} MB ({load_time / stream_time:.1f}x)')
+    print(f'identical tree: {same}')
+
+
+def _legacy_decrypt(data: bytes) -> bytes:
+    '''The per byte loop of main.dec_seria.'''
+
+    data = list(data)
+    a = 0
+    b = 2531011
+    while a < len(data):
+        data[a] = (b ^ (b >> 15) ^ data[a]) & 0xff
+        b += 214013
+        b &= 0xffffffff
+        a += 1
+    return bytes(data)
+
+
+def bench_decrypt(filepath: str):
+    '''Compare the legacy and the current decryption of a .seria_enc file (any file works, it is only xored).'''
+
+    with open(filepath, 'rb') as file:
+        data = file.read()
+    print(f'File: {filepath} ({len(data) / 2 ** 20:.1f} MB)')
+
+    legacy_time = _measure(_legacy_decrypt, data, repeat=1)
+    current_time = _measure(seria.decrypt, data)
+    same = _legacy_decrypt(data) == seria.decrypt(data)
+    print(f'legacy {legacy_time:.3f}s, current {current_time:.3f}s ({legacy_time / current_time:.1f}x), '
+          f'same result: {same}')
+
+
+class _MockTreeview:
+    '''The part of ttk.Treeview that the tree view of main.py uses, kept in dicts so that no display is needed.'''
+
+    def __init__(self):
+        self.children = {'': []}
+        self.parents = dict()
+        self.texts = dict()
+        self.focused = ''
+        self.count = 0
+
+    def insert(self, parent, index, text=''):
+        self.count += 1
+        iid = f'I{self.count:03X}'
+        self.children[parent].append(iid)
+        self.children[iid] = []
+        self.parents[iid] = parent
+        self.texts[iid] = text
+        return iid
+
+    def delete(self, *iids):
+        for iid in iids:
+            self.delete(*self.children[iid])
+            self.children[self.parents.pop(iid)].remove(iid)
+            del self.children[iid]
+            del self.texts[iid]
+
+    def get_children(self, iid=''):
+        return tuple(self.children[iid])
+
+    def parent(self, iid):
+        return self.parents[iid]
+
+    def index(self, iid):
+        return self.children[self.parents[iid]].index(iid)
+
+    def item(self, iid, **options):
+        pass
+
+    def focus(self, iid=None):
+        if iid is None:
+            return self.focused
+        self.focused = iid
+
+    def outline(self, iid='', depth=0) -> list:
+        '''Get the text of every item below an item with its depth, in the order of the tree.'''
+
+        lines = list()
+        for child in self.children[iid]:
+            lines.append('  ' * depth + self.texts[child])
+            lines.extend(self.outline(child, depth + 1))
+        return lines
+
+
+class _MockText:
+    def config(self, **options):
+        pass
+
+    def delete(self, *args):
+        pass
+
+    def insert(self, *args):
+        pass
+
+
+def _mock_controller(filepath: str):
+    import main
+
+    controller = object.__new__(main.SeriaController)
+    controller.seria = seria.load(filepath, lazy=True)
+    controller.tree_seria = _MockTreeview()
+    controller.tree_seria_nodes = dict()
+    controller.text_treeview_detail = _MockText()
+    return controller
+
+
+def _legacy_update_treeview(controller):
+    '''The tree view of main.py before the items were made on open, an item for every node up front.'''
+
+    tree = controller.tree_seria
+    tree.delete(*tree.get_children())
+
+    item_ids = ['']
+    for _, node, depth in seria.traverse(controller.seria):
+        del item_ids[depth + 1:]
+        item_ids.append(tree.insert(item_ids[depth], 'end', text=controller._get_node_summary(node)))
+    tree.item(item_ids[1], open=True)
+
+
+def _open_all(controller):
+    '''Open every item like a user would, one level after the other.'''
+
+    tree = controller.tree_seria
+    pending = list(tree.get_children())
+    while pending:
+        iid = pending.pop()
+        tree.focus(iid)
+        controller._on_tree_seria_open(type('Event', (), {'widget': tree}))
+        pending.extend(tree.get_children(iid))
+
+
+def bench_treeview(filepath: str):
+    '''Compare the eager and the lazy tree view of main.py on a mocked Treeview, from a lazy load of the file.'''
+
+    def legacy():
+        controller = _mock_controller(filepath)
+        _legacy_update_treeview(controller)
+        return controller
+
+    def current():
+        controller = _mock_controller(filepath)
+        controller._update_treeview()
+        return controller
+
+    def current_all():
+        controller = current()
+        _open_all(controller)
+        return controller
+
+    size = os.path.getsize(filepath)
+    print(f'File: {filepath} ({size / 2 ** 20:.1f} MB)')
+
+    for label, function in (('eager, all items', legacy), ('lazy, first level', current),
+                            ('lazy, all opened', current_all)):
+        elapsed = _measure(function)
+        controller = function()
+        print(f'{label:<18} {elapsed:.3f}s, {len(controller.tree_seria.texts)} items')
+
+    same = legacy().tree_seria.outline() == current_all().tree_seria.outline()
+    print(f'identical tree when all items are opened: {same}')
+
+
+def _node_paths(node: seria.SeriaNode) -> list:
+    '''Get the path of child indexes from a node to each node of its subtree, in the order of the file.'''
+
+    paths = list()
+    path = list()
+    # counts[depth] is the index of the next child at that depth
+    counts = [0]
+    for _, _, depth in seria.traverse(node):
+        if depth > 0:
+            del path[depth - 1:]
+            path.append(counts[depth])
+            counts[depth] += 1
+        counts[depth + 1:] = [0]
+        paths.append(tuple(path))
+    return paths
+
+
+def _edit(node: seria.SeriaNode, operation: int, value: str):
+    '''Apply one of the write operations that mark a node dirty.'''
+
+    if operation == 0:
+        node.set_attribute('m_bench', value)
+    elif operation == 1:
+        node.set_attribute('m_classname', node.get_attribute('m_classname'))
+    elif operation == 2:
+        node.put_attribute_after('m_bench_after', value, 'm_classname')
+    elif operation == 3:
+        node.put_attribute_before('m_bench_before', value, 'm_classname')
+    elif operation == 4:
+        node.add_node(seria.SeriaNode('m_bench=1', 'Bench'))
+    elif operation == 5:
+        node.header = None if node.header is None else 'm_bench=' + value
+    elif operation == 6:
+        node.update_attribute_by_value('1', value)
+    elif operation == 7:
+        node.del_attribute(next(iter(node.attribute_names() - {'m_classname'}), 'm_bench'))
+    else:
+        node.data_group = list(node.data_group)
+
+
+def check_edits(filepath: str, rounds: int = 20) -> bool:
+    '''Apply the same random edits to an eager and a lazy tree of a file and compare their dumps.
+    The lazy tree is only walked down to the edited nodes, so most of it stays unparsed and is copied
+    from the original text when it is dumped.'''
+
+    paths = _node_paths(seria.load(filepath))
+    for seed in range(rounds):
+        rng = random.Random(seed)
+        eager = seria.load(filepath)
+        lazy = seria.load(filepath, lazy=True)
+
+        for _ in range(rng.randint(0, 6)):
+            path = rng.choice(paths)
+            operation = rng.randrange(9)
+            for node in (eager, lazy):
+                for index in path:
+                    node = node.get_node(index)
+                _edit(node, operation, str(seed))
+
+        if seria.dump_str(eager) != seria.dump_str(lazy):
+            print(f'lazy and eager dumps differ with seed {seed}')
+            return False
+    return True
+
+
+def check_scan(filepath: str) -> bool:
+    '''Compare the block scan of seria_cli with the regex scan for -attributes and -values of every attribute.'''
+
+    attributes = _legacy_scan(filepath)
+    if seria_cli.file_attributes(filepath) != attributes:
+        print('-attributes differs from the regex scan')
+        return False
+
+    for name in sorted(attributes):
+        if seria_cli.file_values(name, filepath) != _legacy_scan(filepath, name):
+            print(f'-values {name} differs from the regex scan')
+            return False
+    return True
+
+
+def check_decrypt() -> bool:
+    '''Compare seria.decrypt and a chunked SeriaCipher with the per byte loop, around the block size
+    of the keystream and with generator states that wrap around 2 ** 32.'''
+
+    rng = random.Random(0)
+    lanes = seria._KEY_LANES
+    for length in (0, 1, 255, lanes - 1, lanes, lanes + 1, 3 * lanes + 7):
+        data = bytes(rng.randrange(256) for _ in range(length))
+        if seria.decrypt(data) != _legacy_decrypt(data):
+            print(f'seria.decrypt differs for {length} bytes')
+            return False
+
+        cipher = seria.SeriaCipher()
+        chunks = [cipher.update(data[start:start + 7777]) for start in range(0, length, 7777)]
+        if b''.join(chunks) != _legacy_decrypt(data):
+            print(f'SeriaCipher differs for {length} bytes in chunks')
+            return False
+
+    data = bytes(rng.randrange(256) for _ in range(lanes + 11))
+    for state in (0, 0xffffffff - 5, seria._KEY_MASK, 12345):
+        expected = bytearray(data)
+        b = state
+        for index in range(len(expected)):
+            expected[index] ^= (b ^ (b >> 15)) & 0xff
+            b = (b + 214013) & 0xffffffff
+        if seria.decrypt(data, state) != bytes(expected):
+            print(f'seria.decrypt differs from state {state}')
+            return False
+    return True
+
+
+def bench_check(filepath: str) -> bool:
+    '''Run the differential checks on a file and print the result of each one.'''
+
+    print(f'File: {filepath} ({os.path.getsize(filepath) / 2 ** 20:.1f} MB)')
+    passed = True
+    for label, check in (('lazy and eager edits', lambda: check_edits(filepath)),
+                         ('block and regex scan', lambda: check_scan(filepath)),
+                         ('decrypt and per byte loop', check_decrypt)):
+        start = time.perf_counter()
+        result = check()
+        print(f'{label:<26} {"ok" if result else "FAILED"} ({time.perf_counter() - start:.1f}s)')
+        passed = passed and result
+    return passed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        _print_help()
+        sys.exit(0)
+
+    option = sys.argv[1]
+    filepath = sys.argv[2] if len(sys.argv) > 2 else None
+
+    if option == '-load':
+        _with_profile(filepath, bench_load)
+    elif option == '-lazy':
+        _with_profile(filepath, bench_lazy)
+    elif option == '-attributes':
+        bench_attributes()
+    elif option == '-memory':
+        _with_profile(filepath, bench_memory)
+    elif option == '-dump':
+        _with_profile(filepath, bench_dump)
+    elif option == '-save':
+        _with_profile(filepath, bench_save)
+    elif option == '-cache':
+        _with_profile(filepath, bench_cache)
+    elif option == '-jobs':
+        if filepath is None:
+            bench_jobs()
+        elif os.path.isdir(filepath):
+            bench_jobs_directory(filepath)
+        else:
+            bench_jobs(int(filepath))
+    elif option == '-scan':
+        _with_profile(filepath, bench_scan)
+    elif option == '-iterparse':
+        _with_profile(filepath, bench_iterparse)
+    elif option == '-decrypt':
+        _with_profile(filepath, bench_decrypt)
+    elif option == '-treeview':
+        _with_profile(filepath, bench_treeview)
+    elif option == '-check':
+        if not _with_profile(filepath, bench_check):
+            sys.exit(1)
+    elif option == '-deep':
+        bench_deep()
+    else:
+        logging.error(f'Invalid option: {option}')
+        _print_help()
+        sys.exit(1)
@@ -1,68 +1,516 @@
+import functools
+import itertools
+import json
 import logging
+import math
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 import seria
 
 __author__ = 'Max'
 __version__ = '0.3.0'
 
+FLAGSHIP_PATH = 'Frame/Body[m_name=COMBRIDGE]/Creature'
+
+# files are scanned in binary blocks of this size
+_BLOCK_SIZE = 1 << 22
+
+# -stats keeps this many counters for each top value it prints
+_COUNTERS_PER_TOP_VALUE = 10
+# the classname of the attributes outside of any node
+_NO_CLASS = '(none)'
+
 
 def _print_help():
-    print('''Usage: python seria.py [option] <seria_files...>
+    print('''Usage: python seria.py [-jobs <n>] [-merge] [option] <seria_files...>
 Options:
+    -jobs <n>                | Process the files in n processes, 0 for one per CPU
+                             | (-attributes, -values, -stats, -tree and -flagship)
+    -merge                   | Print one list for all files instead of one per file (-attributes, -values and -stats)
     -attributes              | List all distinct attributes
     -values <attribute name> | List all distinct values for the given attribute
     -flagship                | Set the given ship design files to be a flagship
     -tree [<depth>]          | Print the tree structure of the seria file with optional depth
+    -select <path>           | Print the nodes or attribute values that match a path, e.g. //Creature@m_ship_name
+    -stats <attribute names> | Count the values of comma separated attributes, or of all attributes with '*',
+                             | with the numeric min/max and a breakdown by m_classname of the enclosing node
+    -top <k>                 | Print the k most frequent values of each attribute (-stats, 10 by default)
+    -json                    | Print the statistics as JSON (-stats)
+Files ending in .seria_enc are decrypted while they are read and encrypted again when they are written.
 Example:
-    python seria.py -values m_classname profile.seria parts.seria''')
+    python seria.py -values m_classname profile.seria parts.seria
+    python seria.py -json -stats m_name,m_cash profile.seria''')
 
 
-def process_files_by_line(filepaths, process_line):
-    '''Process files with the given line processing function'''
+def read_blocks(filepath):
+    '''Read a file in large binary blocks that each end at a line break, with '\\r\\n' and '\\r' turned into '\\n'
+    the same way as a file opened in text mode.'''
 
-    for filepath in filepaths:
-        try:
-            with open(filepath, 'r', encoding='cp1251') as file:
-                result_set = set()
+    # an encrypted file is decrypted one chunk at a time
+    file = seria.open_encrypted(filepath, 'rb') if seria.is_encrypted(filepath) else open(filepath, 'rb')
+    with file:
+        rest = b''
+        while True:
+            block = file.read(_BLOCK_SIZE)
+            if not block:
+                break
+
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            block, rest = block[:end], block[end:]
+            if block:
+                yield _normalize_newlines(block)
+
+        if rest:
+            yield _normalize_newlines(rest)
+
+
+def _normalize_newlines(block: bytes) -> bytes:
+    if b'\r' in block:
+        block = block.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return block
+
+
+def _is_attribute_name(name: str) -> bool:
+    # same names as seria.ATTRIBUTE_PATTERN
+    return len(name) > 0 and name[0] in seria._NAME_START_CHARS and not name.strip(seria._NAME_CHARS)
+
+
+def file_attributes(filepath) -> set:
+    '''Get the distinct attributes of a file, the names before the first '=' of each line.'''
+
+    names = set()
+    for block in read_blocks(filepath):
+        # the text of a line before its first '=' is what follows the last line break of a piece,
+        # pieces without a line break are values and lines without '=' (braces, mesh) are never looked at
+        pieces = block.split(b'=')
+        if len(pieces) < 2:
+            continue
+
+        # a block starts a line, so the first piece counts from its start
+        names.add(pieces[0][pieces[0].rfind(b'\n') + 1:])
+        for piece in itertools.islice(pieces, 1, len(pieces) - 1):
+            start = piece.rfind(b'\n')
+            if start != -1:
+                names.add(piece[start + 1:])
+
+    return {name for name in (name.decode('cp1251') for name in names) if _is_attribute_name(name)}
+
+
+def file_values(attribute_name, filepath) -> set:
+    '''Get the distinct values of an attribute in a file.'''
+
+    if not _is_attribute_name(attribute_name):
+        return set()
+
+    prefix = attribute_name.encode('cp1251') + b'='
+    needle = b'\n' + prefix
+    values = set()
+
+    for block in read_blocks(filepath):
+        if block.startswith(prefix):
+            # the first line of a block has no line break before it
+            position = -1
+        else:
+            position = block.find(needle)
+            if position == -1:
+                continue
+
+        while True:
+            start = position + len(needle)
+            end = block.find(b'\n', start)
+            if end == -1:
+                end = len(block)
+            values.add(block[start:end])
+
+            position = block.find(needle, end)
+            if position == -1:
+                break
+
+    return {value.decode('cp1251') for value in values}
+
+
+def file_tree(filepath, max_depth=None) -> str:
+    '''Write the tree structure of a file to <file>-tree.txt in the format of seria.tree, one node at a time.
+    @param max_depth: the number of levels to write, all levels if None.
+    @return: the path of the written file.'''
+
+    output_filepath = filepath + '-tree.txt'
+    depth = -1
+    separator = ''
+    with open(output_filepath, 'w') as file:
+        for event, _, classname in seria.iterparse(filepath):
+            if event == seria.START_NODE:
+                depth += 1
+                if max_depth is None or depth < max_depth:
+                    file.write(separator + '  ' * depth + classname)
+                    separator = '\n'
+            elif event == seria.END_NODE:
+                depth -= 1
 
-                for line in file:
-                    process_line(line, result_set)
+    return output_filepath
 
-                # allows the caller to iterate over the results
-                yield filepath, result_set
-        except IOError:
-            logging.error('Could not open file: ' + filepath)
 
+def set_flagship(filepath):
+    '''Set the ship design in a file to be a flagship, only the nodes on the path to the flagship are written again.
+    @return: True if the file was written, or None if the error was logged.'''
 
-def list_attributes(filepaths):
+    node = seria.load(filepath, lazy=True)
+    if node is None:
+        return None
+    # copy the file into memory, so that a change to it before the dump cannot corrupt the output
+    seria.detach(node)
+
+    creature_node = node.select_one(FLAGSHIP_PATH)
+    if creature_node is None:
+        logging.error('Could not find the command bridge creature in file: ' + filepath)
+        return None
+
+    creature_node.put_attribute_after(
+        'm_flagship', 'true', 'm_playable')
+    return seria.dump(node, filepath) or None
+
+
+def _process_file(process_file, filepath):
+    try:
+        return process_file(filepath)
+    except IOError:
+        logging.error('Could not open file: ' + filepath)
+    except ValueError as error:
+        logging.error(f'Could not parse file {filepath}: {error}')
+    return None
+
+
+def process_files(filepaths, process_file, jobs=1):
+    '''Apply a function to each file, in a pool of processes if jobs is more than 1.
+    Yield (filepath, result) in the order of the files, a file that could not be opened is logged and skipped.
+    With a pool, process_file must be a module level function (or a functools.partial of one)
+    so that it can be sent to the processes.'''
+
+    if jobs <= 1 or len(filepaths) <= 1:
+        results = (_process_file(process_file, filepath) for filepath in filepaths)
+        for filepath, result in zip(filepaths, results):
+            if result is not None:
+                yield filepath, result
+        return
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(filepaths))) as executor:
+        results = executor.map(_process_file, itertools.repeat(process_file), filepaths)
+        for filepath, result in zip(filepaths, results):
+            if result is not None:
+                yield filepath, result
+
+
+def _merge_results(results):
+    '''Merge the results of process_files into a single set.'''
+
+    merged_set = set()
+    filepaths = list()
+    for filepath, result_set in results:
+        filepaths.append(filepath)
+        merged_set.update(result_set)
+    return ', '.join(filepaths), merged_set
+
+
+def list_attributes(filepaths, jobs=1, merge=False):
     '''List all distinct attributes in the given files'''
 
-    def process_line(line, result_set):
-        attribute, _ = seria._match_attribute(line)
-        if attribute is not None:
-            result_set.add(attribute)
+    results = process_files(filepaths, file_attributes, jobs)
+    if merge:
+        results = [_merge_results(results)]
+    label = 'files' if merge else 'file'
 
-    for filepath, attribute_set in process_files_by_line(filepaths, process_line):
-        print(f'Attributes in file {filepath}:')
+    for filepath, attribute_set in results:
+        print(f'Attributes in {label} {filepath}:')
         for attribute in sorted(attribute_set):
             print(attribute)
 
 
-def list_values(attribute_name, filepaths):
+def list_values(attribute_name, filepaths, jobs=1, merge=False):
     '''List all distinct values for the given attribute in the given files'''
 
-    def process_line(line, result_set):
-        attribute, value = seria._match_attribute(line)
-        if attribute == attribute_name:
-            result_set.add(value)
+    results = process_files(filepaths, functools.partial(file_values, attribute_name), jobs)
+    if merge:
+        results = [_merge_results(results)]
+    label = 'files' if merge else 'file'
 
-    for filepath, value_set in process_files_by_line(filepaths, process_line):
-        print(f'Values for attribute {attribute_name} in file {filepath}:')
+    for filepath, value_set in results:
+        print(f'Values for attribute {attribute_name} in {label} {filepath}:')
         for value in sorted(value_set):
             print(value)
 
 
+class TopCounter:
+    '''Count values with a bounded number of counters (the Space-Saving algorithm).
+    The counts are exact until more distinct values than the capacity are seen. After that a new value takes over
+    the counter of the least frequent value, so a frequent value is never dropped. The count it took over is
+    kept as its error: the true count of a value lies between count - error and count.'''
+
+    __slots__ = ('capacity', 'counts', 'errors', 'evicted')
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts = dict()
+        self.errors = dict()
+        self.evicted = False
+
+    def add(self, value, count: int = 1, error: int = 0):
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+            if error:
+                self.errors[value] = self.errors.get(value, 0) + error
+        elif len(counts) < self.capacity:
+            counts[value] = count
+            if error:
+                self.errors[value] = error
+        else:
+            least = min(counts, key=counts.get)
+            least_count = counts.pop(least)
+            self.errors.pop(least, None)
+            counts[value] = least_count + count
+            self.errors[value] = least_count + error
+            self.evicted = True
+
+    def merge(self, other):
+        for value, count in other.counts.items():
+            self.add(value, count, other.errors.get(value, 0))
+        self.evicted = self.evicted or other.evicted
+
+    def most_common(self, k: int) -> list:
+        '''Get the k values with the highest guaranteed count as (value, count, error), most frequent first.'''
+
+        errors = self.errors
+        items = ((value, count, errors.get(value, 0)) for value, count in self.counts.items())
+        return sorted(items, key=lambda item: (item[2] - item[1], -item[1], item[0]))[:k]
+
+
+def _number(value: str):
+    '''Get the number of a value, or None if it is not a finite number.'''
+
+    if value[:1] not in '0123456789-+.' or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+
+class ValueStats:
+    '''Number of values, top values and numeric range of an attribute.'''
+
+    __slots__ = ('count', 'values', 'minimum', 'maximum')
+
+    def __init__(self, top: int):
+        self.count = 0
+        self.values = TopCounter(top * _COUNTERS_PER_TOP_VALUE)
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value: str, number=None):
+        '''@param number: the number of the value from _number, if it has one.'''
+
+        self.count += 1
+        self.values.add(value)
+
+        if number is not None:
+            if self.minimum is None or number < self.minimum:
+                self.minimum = number
+            if self.maximum is None or number > self.maximum:
+                self.maximum = number
+
+    def merge(self, other):
+        self.count += other.count
+        self.values.merge(other.values)
+        for number in (other.minimum, other.maximum):
+            if number is not None:
+                self.minimum = number if self.minimum is None else min(self.minimum, number)
+                self.maximum = number if self.maximum is None else max(self.maximum, number)
+
+    def to_dict(self, top: int) -> dict:
+        return {
+            'count': self.count,
+            'distinct': len(self.values.counts),
+            # after an eviction, distinct is a lower bound and the top counts may be overestimated
+            'exact': not self.values.evicted,
+            'min': self.minimum,
+            'max': self.maximum,
+            'top': [{'value': value, 'count': count, 'error': error}
+                    for value, count, error in self.values.most_common(top)],
+        }
+
+    def describe(self) -> str:
+        distinct = len(self.values.counts)
+        text = f'{self.count} values, {distinct}{"+" if self.values.evicted else ""} distinct'
+        if self.minimum is not None:
+            text += f', min {self.minimum}, max {self.maximum}'
+        return text
+
+
+class AttributeStats:
+    '''ValueStats of an attribute over a file and for each m_classname of the nodes that hold it.'''
+
+    __slots__ = ('top', 'total', 'classes')
+
+    def __init__(self, top: int):
+        self.top = top
+        self.total = ValueStats(top)
+        self.classes = dict()
+
+    def add(self, classname: str, value: str):
+        number = _number(value)
+        self.total.add(value, number)
+        class_stats = self.classes.get(classname)
+        if class_stats is None:
+            class_stats = self.classes[classname] = ValueStats(self.top)
+        class_stats.add(value, number)
+
+    def merge(self, other):
+        self.total.merge(other.total)
+        for classname, class_stats in other.classes.items():
+            if classname in self.classes:
+                self.classes[classname].merge(class_stats)
+            else:
+                self.classes[classname] = class_stats
+
+    def to_dict(self) -> dict:
+        result = self.total.to_dict(self.top)
+        result['classes'] = {classname: class_stats.to_dict(self.top)
+                             for classname, class_stats in sorted(self.classes.items())}
+        return result
+
+
+def file_stats(attribute_names, top, filepath) -> dict:
+    '''Count the values of some attributes in a single pass over a file.
+    @param attribute_names: a set of attribute names, or None for all attributes.
+    @return: a dict of attribute name to AttributeStats.'''
+
+    stats = dict()
+    # m_classname of the enclosing nodes
+    classnames = list()
+
+    for event, name, value in seria.iterparse(filepath):
+        if event == seria.START_NODE:
+            classnames.append(value)
+            name = 'm_classname'
+        elif event == seria.END_NODE:
+            classnames.pop()
+            continue
+        elif event != seria.ATTRIBUTE:
+            continue
+
+        if attribute_names is not None and name not in attribute_names:
+            continue
+
+        attribute_stats = stats.get(name)
+        if attribute_stats is None:
+            attribute_stats = stats[name] = AttributeStats(top)
+        attribute_stats.add(classnames[-1] if classnames else _NO_CLASS, value)
+
+    return stats
+
+
+def _merge_stats(results):
+    '''Merge the results of process_files with file_stats into a single result.'''
+
+    merged_stats = dict()
+    filepaths = list()
+    for filepath, stats in results:
+        filepaths.append(filepath)
+        for name, attribute_stats in stats.items():
+            if name in merged_stats:
+                merged_stats[name].merge(attribute_stats)
+            else:
+                merged_stats[name] = attribute_stats
+    return ', '.join(filepaths), merged_stats
+
+
+def _format_count(count: int, error: int) -> str:
+    return str(count) if error == 0 else f'{count - error}..{count}'
+
+
+def print_stats(attribute_names, filepaths, jobs=1, merge=False, top=10, as_json=False):
+    '''Print the value statistics of some attributes (None for all) in the given files'''
+
+    results = process_files(filepaths, functools.partial(file_stats, attribute_names, top), jobs)
+    if merge:
+        results = [_merge_stats(results)]
+    label = 'files' if merge else 'file'
+
+    if as_json:
+        output = {filepath: {name: stats[name].to_dict() for name in sorted(stats)} for filepath, stats in results}
+        print(json.dumps(output, ensure_ascii=False, indent=2))
+        return
+
+    for filepath, stats in results:
+        print(f'Statistics in {label} {filepath}:')
+        for name in sorted(stats):
+            attribute_stats = stats[name]
+            print(f'{name}: {attribute_stats.total.describe()}')
+            for value, count, error in attribute_stats.total.values.most_common(top):
+                print(f'    {value}: {_format_count(count, error)}')
+
+            for classname, class_stats in sorted(attribute_stats.classes.items()):
+                print(f'  in {classname}: {class_stats.describe()}')
+                for value, count, error in class_stats.values.most_common(top):
+                    print(f'      {value}: {_format_count(count, error)}')
+
+
+def select(path, filepaths):
+    '''Print the nodes or attribute values that match a path in the given files'''
+
+    try:
+        compiled_path = seria.compile_path(path)
+    except ValueError as error:
+        logging.error(error)
+        return
+
+    for filepath in filepaths:
+        node = seria.load(filepath, lazy=True)
+        if node is None:
+            continue
+        seria.detach(node)
+
+        print(f'Matches for {path} in file {filepath}:')
+        for match in compiled_path.iterate(node):
+            print(match if compiled_path.attribute is not None else seria.dump_str(match))
+
+
 if __name__ == '__main__':
+    jobs = 1
+    merge = False
+    top = 10
+    as_json = False
+
+    # options for all files come before the option that selects what to do
+    while len(sys.argv) > 1 and sys.argv[1] in ('-jobs', '-merge', '-top', '-json'):
+        if sys.argv[1] in ('-merge', '-json'):
+            merge = merge or sys.argv[1] == '-merge'
+            as_json = as_json or sys.argv[1] == '-json'
+            del sys.argv[1]
+            continue
+
+        try:
+            number = int(sys.argv[2])
+            if number < 0:
+                raise ValueError
+        except (IndexError, ValueError):
+            logging.error(f'{sys.argv[1]} needs a number')
+            _print_help()
+            sys.exit(1)
+
+        if sys.argv[1] == '-jobs':
+            jobs = number or os.cpu_count() or 1
+        else:
+            top = max(number, 1)
+        del sys.argv[1:3]
+
     argv_len = len(sys.argv)
 
     if argv_len < 3:
@@ -72,14 +520,14 @@ if __name__ == '__main__':
     option = sys.argv[1]
 
     if option == '-attributes':
-        list_attributes(sys.argv[2:])
+        list_attributes(sys.argv[2:], jobs, merge)
     elif option == '-values':
         if argv_len < 4:
             logging.error('Missing attribute name')
             _print_help()
             sys.exit(1)
 
-        list_values(sys.argv[2], sys.argv[3:])
+        list_values(sys.argv[2], sys.argv[3:], jobs, merge)
     elif option == '-tree':
         try:
             depth = int(sys.argv[2])
@@ -88,26 +536,31 @@ if __name__ == '__main__':
             depth = None
             file_index = 2
 
-        for filepath in sys.argv[file_index:]:
-            try:
-                node = seria.load(filepath)
-                output_filepath = filepath + '-tree.txt'
-                with open(output_filepath, 'w') as file:
-                    file.write(seria.tree(node, depth))
-                    print(f'Tree structure written to {output_filepath}')
-            except IOError:
-                logging.error('Could not open file: ' + filepath)
+        if depth is not None and depth < 1:
+            logging.error('max_depth must be greater or equal to 1')
+            depth = 1
+
+        for _, output_filepath in process_files(sys.argv[file_index:], functools.partial(file_tree, max_depth=depth),
+                                                jobs):
+            print(f'Tree structure written to {output_filepath}')
+    elif option == '-stats':
+        if argv_len < 4:
+            logging.error('Missing attribute names')
+            _print_help()
+            sys.exit(1)
+
+        attribute_names = None if sys.argv[2] == '*' else set(sys.argv[2].split(','))
+        print_stats(attribute_names, sys.argv[3:], jobs, merge, top, as_json)
+    elif option == '-select':
+        if argv_len < 4:
+            logging.error('Missing path')
+            _print_help()
+            sys.exit(1)
+
+        select(sys.argv[2], sys.argv[3:])
     elif option == '-flagship':
-        for filepath in sys.argv[2:]:
-            try:
-                node = seria.load(filepath)
-                creature_node = node.get_node_by_class('Frame').get_node_if(lambda x: x.get_attribute(
-                    'm_name') == 'COMBRIDGE').get_node_by_class('Creature')
-                creature_node.put_attribute_after(
-                    'm_flagship', 'true', 'm_playable')
-                seria.dump(node, filepath)
-            except IOError:
-                logging.error('Could not open file: ' + filepath)
+        # the errors are logged, nothing is printed for the written files
+        list(process_files(sys.argv[2:], set_flagship, jobs))
     else:
         logging.error(f'Invalid option: {option}')
         _print_help()